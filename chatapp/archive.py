@@ -0,0 +1,172 @@
+# chatapp/archive.py
+"""
+Cold storage for old messages.
+
+`manage.py archive_messages` moves messages older than a cutoff out of the
+Message table into per-conversation segment files under
+settings.MESSAGE_ARCHIVE_DIR:
+
+    <archive dir>/<conversation id>/index.json
+    <archive dir>/<conversation id>/<first id>-<last id>.jsonl.gz
+
+A segment is gzipped JSON lines, one message per line, with the content still
+encrypted exactly as it was stored in the database. Segments are written once
+and never changed. Archiving again only adds segments and appends them to the
+index, which lists the (timestamp, id) range of every segment so a reader
+opens just the segments a page needs.
+
+Archived messages are older than every live message of their conversation,
+so the history pager reads the database first and only continues into the
+archive once it runs out of rows.
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from django.conf import settings
+
+INDEX_FILE = 'index.json'
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+
+def conversation_dir(conversation_id):
+    return Path(settings.MESSAGE_ARCHIVE_DIR) / str(conversation_id)
+
+
+def _sort_key(message):
+    return message.timestamp, message.pk
+
+
+def _write_atomically(path, data):
+    """Write a whole file under a temporary name and rename it into place"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+@lru_cache(maxsize=1024)
+def _load_index(path, mtime_ns):
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    for entry in entries:
+        entry['first_timestamp'] = datetime.fromisoformat(entry['first_timestamp'])
+        entry['last_timestamp'] = datetime.fromisoformat(entry['last_timestamp'])
+    return tuple(entries)
+
+
+def read_index(conversation_id):
+    """Segments of one conversation, oldest first (empty if nothing was archived)"""
+    path = conversation_dir(conversation_id) / INDEX_FILE
+    try:
+        mtime_ns = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return ()
+    return _load_index(path, mtime_ns)
+
+
+def _read_segment(path):
+    """Stream the records of one segment, oldest first"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+            yield record
+
+
+@lru_cache(maxsize=64)
+def _load_segment(path):
+    """All records of one segment. Segments never change, so caching by path is safe"""
+    return tuple(_read_segment(path))
+
+
+def _to_message(record, users=None):
+    """Unsaved Message for an archived record, content still encrypted until first read"""
+    from .models import Message
+    message = Message(id=record['id'], sender_id=record['sender_id'], receiver_id=record['receiver_id'],
+                      _content=record['content'], timestamp=record['timestamp'], client_key=record['client_key'])
+    if users:
+        # Attach the participants we already have so templates don't look them up per row
+        message.sender, message.receiver = users[message.sender_id], users[message.receiver_id]
+    return message
+
+
+def segment_messages(conversation_id, entry, users=None):
+    return [_to_message(record, users)
+            for record in _load_segment(conversation_dir(conversation_id) / entry['file'])]
+
+
+def messages_before(conversation_id, cursor=None, limit=1, users=None):
+    """
+    Up to `limit` archived messages strictly older than the (timestamp, id) cursor, newest first.
+
+    Segments are visited newest first and reading stops as soon as the page is
+    full, so a page costs one or two segment reads however old it is.
+    `users` maps user ids to User objects to attach as sender/receiver.
+    """
+    rows = []
+    for entry in reversed(read_index(conversation_id)):
+        if len(rows) >= limit:
+            break
+        if cursor is not None and (entry['first_timestamp'], entry['first_id']) >= cursor:
+            continue
+        rows.extend(message for message in segment_messages(conversation_id, entry, users)
+                    if cursor is None or _sort_key(message) < cursor)
+    rows.sort(key=_sort_key, reverse=True)
+    return rows[:limit]
+
+
+def iter_messages(conversation_id, users=None):
+    """Every archived message of one conversation, oldest first, streamed past the segment cache"""
+    directory = conversation_dir(conversation_id)
+    for entry in read_index(conversation_id):
+        for record in _read_segment(directory / entry['file']):
+            yield _to_message(record, users)
+
+
+def last_archived_id(conversation_id):
+    """Id of the newest archived message of one conversation, 0 if there is none"""
+    return max((entry['last_id'] for entry in read_index(conversation_id)), default=0)
+
+
+def write_segment(conversation_id, messages):
+    """
+    Append one segment of saved messages (in (timestamp, id) order) to a conversation's archive.
+
+    The segment file is complete on disk before the index mentions it; rows
+    should only be deleted from the database after this returns.
+    """
+    directory = conversation_dir(conversation_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    first, last = messages[0], messages[-1]
+    name = f'{first.pk}-{last.pk}{SEGMENT_SUFFIX}'
+
+    lines = ''.join(json.dumps({
+        'id': message.pk,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'content': message._content,
+        'timestamp': message.timestamp.isoformat(),
+        'client_key': message.client_key,
+    }, separators=(',', ':')) + '\n' for message in messages)
+    # mtime=0 keeps the file byte-for-byte reproducible
+    _write_atomically(directory / name, gzip.compress(lines.encode('utf-8'), mtime=0))
+
+    entry = {
+        'file': name,
+        'count': len(messages),
+        'first_id': first.pk,
+        'last_id': max(message.pk for message in messages),
+        'first_timestamp': first.timestamp.isoformat(),
+        'last_timestamp': last.timestamp.isoformat(),
+    }
+    entries = [
+        {**e, 'first_timestamp': e['first_timestamp'].isoformat(), 'last_timestamp': e['last_timestamp'].isoformat()}
+        for e in read_index(conversation_id)
+    ]
+    _write_atomically(directory / INDEX_FILE, json.dumps(entries + [entry], indent=1).encode('utf-8'))
+    return entry
@@ -0,0 +1,100 @@
+# chatapp/benchmarks/fanout.py
+"""
+Channel-layer fan-out benchmark.
+
+Measures group_send on its own, without consumers or the database: one
+group of `group_size` channels, each drained by its own receiver task, and
+`messages` group sends into it. A group of 2 is a 1:1 chat, a large one is
+the presence lobby. Every scenario reports how many deliveries arrived,
+deliveries per second and delivery latency percentiles.
+
+Layers are built straight from a CHANNEL_LAYERS style config (see
+settings.CHANNEL_LAYER_BACKENDS), with their own key prefix so a run never
+touches the application's channels.
+
+Run it through `python manage.py benchmark_fanout`.
+"""
+import asyncio
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from django.utils.module_loading import import_string
+from .harness import percentile
+
+BENCH_PREFIX = 'bench-fanout'
+
+
+@dataclass
+class FanoutScenario:
+    name: str
+    group_size: int  # receiving channels in the group
+    messages: int = 100  # group sends
+    payload_bytes: int = 200  # size of the text in every message
+    timeout: float = 30.0  # seconds to wait for all deliveries
+
+
+def build_layer(config):
+    """Instantiate a channel layer from a {'BACKEND', 'CONFIG'} dict under the benchmark prefix"""
+    options = dict(config.get('CONFIG', {}))
+    if 'hosts' in options:
+        options['prefix'] = BENCH_PREFIX
+    return import_string(config['BACKEND'])(**options)
+
+
+async def run_fanout(layer, scenario):
+    """Run one fan-out scenario against a layer and return its results as a dict"""
+    group = f'fanout_{uuid.uuid4().hex[:12]}'
+    channels = [await layer.new_channel() for _ in range(scenario.group_size)]
+    for channel in channels:
+        await layer.group_add(group, channel)
+
+    latencies = []
+
+    async def drain(channel):
+        for _ in range(scenario.messages):
+            message = await layer.receive(channel)
+            latencies.append(time.perf_counter() - message['sent'])
+
+    receivers = [asyncio.create_task(drain(channel)) for channel in channels]
+    await asyncio.sleep(0)  # Let every receiver start listening (pub/sub drops what nobody awaits)
+
+    payload = 'x' * scenario.payload_bytes
+    started = time.perf_counter()
+    for _ in range(scenario.messages):
+        await layer.group_send(group, {'type': 'bench.message', 'sent': time.perf_counter(), 'text': payload})
+    send_elapsed = time.perf_counter() - started
+
+    done, pending = await asyncio.wait(receivers, timeout=scenario.timeout)
+    elapsed = time.perf_counter() - started
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for channel in channels:
+        await layer.group_discard(group, channel)
+
+    expected = scenario.group_size * scenario.messages
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        'scenario': asdict(scenario),
+        'delivered': len(latencies),
+        'expected': expected,
+        'sends_per_s': scenario.messages / send_elapsed if send_elapsed else None,
+        'deliveries_per_s': len(latencies) / elapsed if elapsed else None,
+        'latency_ms': {
+            'p50': percentile(latencies_ms, 50),
+            'p95': percentile(latencies_ms, 95),
+            'p99': percentile(latencies_ms, 99),
+        },
+    }
+
+
+async def run_backend(config, scenarios):
+    """Run every scenario against one layer config, cleaning up its keys afterwards"""
+    layer = build_layer(config)
+    try:
+        return [await run_fanout(layer, scenario) for scenario in scenarios]
+    finally:
+        if hasattr(layer, 'flush'):
+            await layer.flush()
+        if hasattr(layer, 'close_pools'):
+            await layer.close_pools()
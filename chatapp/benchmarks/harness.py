@@ -0,0 +1,247 @@
+# chatapp/benchmarks/harness.py
+"""
+In-process load test for ChatConsumer.
+
+Simulated users talk to the real consumer through channels'
+WebsocketCommunicator and whatever channel layer / cache the settings point
+at (in-memory by default, Redis if the caller configures it). Users are
+paired up, connect in waves, open their chat, type and send messages, then
+disconnect in waves. Each scenario reports delivery latency percentiles,
+throughput and how many SQL queries every phase needed.
+
+Run it through `python manage.py benchmark_chat`.
+"""
+import asyncio
+import json
+import math
+import statistics
+import time
+from dataclasses import asdict, dataclass
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+BENCH_USER_PREFIX = 'bench_'
+
+
+@dataclass
+class Scenario:
+    name: str
+    users: int  # rounded up to an even number, users chat in pairs
+    messages: int = 10  # sent by every user
+    waves: int = 5  # connect/disconnect batches
+    typing: int = 3  # typing frames before every message
+    timeout: float = 30.0  # seconds to wait for all deliveries
+
+
+class QueryCounter:
+    """
+    Execute wrapper counting every SQL statement.
+
+    Consumer DB work runs on the thread-sensitive executor thread, which keeps
+    its own connection, so the wrapper is attached there as well as to any
+    connection that opens while the counter is installed.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._attached = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def attach(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+            self._attached.append(connection)
+
+    def _attach_current(self):
+        for connection in connections.all():
+            self.attach(connection)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        self.attach(connection)
+
+    async def __aenter__(self):
+        connection_created.connect(self._on_connection_created)
+        await database_sync_to_async(self._attach_current)()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        connection_created.disconnect(self._on_connection_created)
+        for connection in self._attached:
+            connection.execute_wrappers.remove(self)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, None for no samples"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class SimulatedUser:
+    """One WebSocket client: keeps reading frames and timing the messages meant for it"""
+
+    def __init__(self, application, user, partner):
+        self.user = user
+        self.partner = partner
+        self.communicator = WebsocketCommunicator(application, '/ws/chat/')
+        self.communicator.scope['user'] = user
+        self.latencies = []
+        self.reader = None
+        self.ready = asyncio.Event()  # Set once the consumer finished its connect sequence
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f"{self.user.username} could not connect")
+        self.reader = asyncio.create_task(self._read())
+        # What every page subscribes to, the unread counts come back last
+        await self.send({'type': 'subscribe', 'topics': ['presence', 'notifications']})
+        await asyncio.wait_for(self.ready.wait(), timeout)
+
+    async def _read(self):
+        while True:
+            frame = await self.communicator.receive_output(timeout=3600)
+            if frame['type'] != 'websocket.send' or not frame.get('text'):
+                continue
+            event = json.loads(frame['text'])
+            if event.get('type') == 'unread_counts':
+                self.ready.set()  # Answer to the notifications subscription
+            elif event.get('type') == 'chat_message' and event.get('receiver') == self.user.username:
+                sent_at = float(event['message'].rsplit(':', 1)[1])
+                self.latencies.append(time.perf_counter() - sent_at)
+
+    async def send(self, data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def chat(self, scenario):
+        await self.send({'type': 'subscribe', 'topics': [f'conversation:{self.partner}']})
+        for seq in range(scenario.messages):
+            for _ in range(scenario.typing):
+                await self.send({'type': 'typing', 'is_typing': True, 'receiver': self.partner})
+            await self.send({
+                'type': 'chat_message',
+                'receiver': self.partner,
+                'message': f"{self.user.username}:{seq}:{time.perf_counter()}"
+            })
+            await asyncio.sleep(0)
+
+    async def disconnect(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+@database_sync_to_async
+def create_users(count):
+    """Create (or reuse) `count` benchmark users"""
+    names = [f"{BENCH_USER_PREFIX}{i:05d}" for i in range(count)]
+    existing = set(User.objects.filter(username__in=names).values_list('username', flat=True))
+    User.objects.bulk_create([User(username=name, password='!') for name in names if name not in existing])
+    users = {user.username: user for user in User.objects.filter(username__in=names)}
+    return [users[name] for name in names]
+
+
+def _waves(items, waves):
+    size = max(1, math.ceil(len(items) / max(1, waves)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def run_scenario(scenario, application=None):
+    """Run one scenario against ChatConsumer and return its results as a dict"""
+    from chatapp.routing import urlpatterns
+    application = application or URLRouter(urlpatterns)
+
+    users = await create_users(scenario.users + scenario.users % 2)
+    clients = [
+        SimulatedUser(application, user, users[index ^ 1].username)
+        for index, user in enumerate(users)
+    ]
+
+    queries = {}
+    async with QueryCounter() as counter:
+        started = time.perf_counter()
+        connect_times = []
+        for wave in _waves(clients, scenario.waves):
+            wave_started = time.perf_counter()
+            await asyncio.gather(*(client.connect(scenario.timeout) for client in wave))
+            connect_times.append((time.perf_counter() - wave_started) / len(wave))
+        connect_elapsed = time.perf_counter() - started
+        queries['connect'], counter.count = counter.count, 0
+
+        expected = len(clients) * scenario.messages
+        started = time.perf_counter()
+        await asyncio.gather(*(client.chat(scenario) for client in clients))
+        deadline = time.monotonic() + scenario.timeout
+        while sum(len(c.latencies) for c in clients) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        chat_elapsed = time.perf_counter() - started
+        queries['chat'], counter.count = counter.count, 0
+
+        started = time.perf_counter()
+        for wave in _waves(clients, scenario.waves):
+            await asyncio.gather(*(client.disconnect() for client in wave))
+        disconnect_elapsed = time.perf_counter() - started
+        queries['disconnect'] = counter.count
+
+    latencies = [latency * 1000 for client in clients for latency in client.latencies]
+    delivered = len(latencies)
+    return {
+        'scenario': asdict(scenario),
+        'delivered': delivered,
+        'expected': expected,
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'mean': statistics.fmean(latencies) if latencies else None,
+        },
+        'throughput_msgs_per_s': delivered / chat_elapsed if chat_elapsed else None,
+        'connect_ms_per_user': statistics.fmean(connect_times) * 1000 if connect_times else None,
+        'elapsed_s': {
+            'connect': connect_elapsed,
+            'chat': chat_elapsed,
+            'disconnect': disconnect_elapsed,
+        },
+        'queries': {
+            **queries,
+            'per_message': queries['chat'] / expected if expected else None,
+        },
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    List human readable regressions of `results` against a saved baseline.
+
+    Latency and throughput may drift by `tolerance` (a fraction) before they
+    count; query counts are deterministic, so any increase is a regression.
+    """
+    regressions = []
+    previous = {run['scenario']['name']: run for run in baseline.get('runs', [])}
+    for run in results['runs']:
+        name = run['scenario']['name']
+        before = previous.get(name)
+        if before is None:
+            continue
+        for pct in ('p95', 'p99'):
+            old, new = before['latency_ms'][pct], run['latency_ms'][pct]
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{name}: {pct} latency {old:.2f}ms -> {new:.2f}ms")
+        old, new = before['throughput_msgs_per_s'], run['throughput_msgs_per_s']
+        if old and new and new < old * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old:.0f}/s -> {new:.0f}/s")
+        for phase in ('connect', 'chat', 'disconnect'):
+            old, new = before['queries'][phase], run['queries'][phase]
+            if new > old:
+                regressions.append(f"{name}: {phase} queries {old} -> {new}")
+        if run['delivered'] < run['expected']:
+            regressions.append(f"{name}: delivered {run['delivered']}/{run['expected']} messages")
+    return regressions
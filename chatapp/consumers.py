@@ -1,16 +1,35 @@
 # chatapp/consumers.py
-import json
+import asyncio
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.signals import user_logged_out
 from django.dispatch import receiver
-from asgiref.sync import async_to_sync
+from .db import database_sync_to_async
+from .directory import user_directory
+from .conversations import get_conversation_id
+from .groups import conversation_group_name, user_group_name
+from .metrics import WS_CONNECTIONS, WS_HANDLER_SECONDS, WS_SLOW_CLIENT_DISCONNECTS, group_send
+from .outbound import OutboundQueue
+from .pagination import get_messages_since
+from .persistence import get_message_writer
+from .protocol import ProtocolError, decode_frame, negotiate
+from .heartbeats import ensure_presence_flusher, get_heartbeat_store
+from .presence import PRESENCE_GROUP, get_presence_snapshot
+from .unread import get_unread_counts, mark_read, send_read_receipt
 
 # Set up logging for debugging
 logger = logging.getLogger(__name__)
 
+# Topics a socket can subscribe to (one socket per page carries all of them)
+TOPIC_PRESENCE = 'presence'  # Presence snapshot and deltas
+TOPIC_NOTIFICATIONS = 'notifications'  # Unread counters and new message notices
+CONVERSATION_TOPIC_PREFIX = 'conversation:'  # + username: typing indicators of that chat
+
+# Close code for clients dropped because they read events slower than they arrive
+SLOW_CLIENT_CLOSE_CODE = 4008
+
 class ChatConsumer(AsyncWebsocketConsumer):
     """Handles real-time chat and user status updates via WebSocket"""
 
@@ -22,22 +41,40 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        self.lobby_group_name = 'chat_lobby'  # Group for all connected users
-        self.private_groups = {}  # Tracks private chat groups for this user
+        self.lobby_group_name = PRESENCE_GROUP  # Group for every socket subscribed to presence
+        self.user_group_name = user_group_name(self.user.id)  # Only this user's sockets
+        self.private_groups = {}  # username -> conversation group joined for typing indicators
+        self.recipients = {}  # username -> user id, resolved once per chat session
+        self.recipients_generation = user_directory.generation
+        self.typing_deadlines = {}  # receiver -> loop time after which typing stops on its own
+        self.typing_tasks = {}  # receiver -> task that expires the typing state
+        self.codec, subprotocol = negotiate(self.scope)  # JSON text frames unless msgpack was asked for
+        self.outbound = OutboundQueue(  # Everything sent to the client goes through here, see send_event
+            self.send_events, self.on_outbound_overflow,
+            max_size=settings.CHAT_OUTBOUND_QUEUE_SIZE,
+            high_water=settings.CHAT_OUTBOUND_HIGH_WATER,
+            slow_timeout=settings.CHAT_SLOW_CLIENT_TIMEOUT,
+            batch_window=settings.CHAT_BATCH_WINDOW if self.codec.batched else 0
+        )
+        self.topics = set()  # What this socket subscribed to, see handle_subscribe
+        self.close_task = None  # Closing a slow client, kept so the task isn't garbage-collected
 
         logger.info(f"{self.user.username} connected with channel {self.channel_name}")
 
-        # Add user to the lobby group for broadcasting status updates
-        await self.channel_layer.group_add(self.lobby_group_name, self.channel_name)
-        await self.accept()
+        # Join the user's own group for messages and notifications addressed to them
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        await self.accept(subprotocol=subprotocol)
+        self.outbound.start()
+        WS_CONNECTIONS.inc()
 
-        # Mark user as online and notify everyone
-        await self.update_user_status(True)
-        await self.send(text_data=json.dumps({
+        # Mark user as online (everyone gets the delta from the next presence flush)
+        await get_heartbeat_store().beat(self.user.id, self.channel_name, settings.PRESENCE_TTL)
+        ensure_presence_flusher(self.channel_layer)
+        await self.send_event({
             'type': 'init',
-            'username': self.user.username
-        }))
-        await self._broadcast_user_list_update()  # Notify all users of the new connection
+            'username': self.user.username,
+            'ping_interval': settings.PRESENCE_PING_INTERVAL
+        })
 
     async def disconnect(self, close_code):
         """When a user disconnects (e.g., closes tab or logs out)"""
@@ -45,88 +82,239 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         logger.info(f"{self.user.username} disconnected with code {close_code}")
+        WS_CONNECTIONS.dec()
         
-        # Mark user as offline and notify everyone
-        await self.update_user_status(False)
-        await self.channel_layer.group_discard(self.lobby_group_name, self.channel_name)
+        # Drop this socket's heartbeat, the user goes offline with the next flush unless another one is alive
+        await get_heartbeat_store().drop(self.user.id, self.channel_name)
+        if TOPIC_PRESENCE in self.topics:
+            await self.channel_layer.group_discard(self.lobby_group_name, self.channel_name)
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
         
-        # Leave any private chats
+        # Stop any typing indicators this socket left on, then leave private chats
+        for receiver_username in list(self.typing_tasks):
+            await self.set_typing(receiver_username, False)
         for group_name in self.private_groups.values():
             await self.channel_layer.group_discard(group_name, self.channel_name)
-        
-        await self._broadcast_user_list_update()  # Let everyone know this user is gone
 
-    async def receive(self, text_data):
+        await self.outbound.stop()
+        if self.close_task is not None and not self.close_task.done():
+            self.close_task.cancel()
+
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle messages sent from the client"""
-        data = json.loads(text_data)
+        try:
+            data = decode_frame(self.codec, text_data, bytes_data)
+        except ProtocolError as e:
+            logger.warning(f"Dropped a frame from {self.user.username}: {str(e)}")
+            return
         message_type = data.get('type', 'chat_message')
         logger.debug(f"{self.user.username} sent: {data}")
 
         handlers = {
+            'subscribe': self.handle_subscribe,
+            'unsubscribe': self.handle_unsubscribe,
             'chat_message': self.handle_chat_message,
             'typing': self.handle_typing,
-            'start_chat': self.handle_start_chat
+            'start_chat': self.handle_start_chat,
+            'presence_sync': self.handle_presence_sync,
+            'resume': self.handle_resume,
+            'read': self.handle_read,
+            'ping': self.handle_ping
         }
         
         if message_type in handlers:
-            await handlers[message_type](data)
+            handler = handlers[message_type]
+            with WS_HANDLER_SECONDS.time(handler=handler.__name__):
+                await handler(data)
 
     async def handle_start_chat(self, data):
-        """Start a private chat with another user"""
+        """Open a chat with another user: resolve them and join the chat group for typing indicators"""
         receiver_username = data['receiver']
-        group_name = self._generate_group_name(receiver_username)
+        receiver_id = await user_directory.resolve(receiver_username)
+        if receiver_id is None:
+            logger.error(f"User {receiver_username} doesn’t exist")
+            return
+        self.recipients[receiver_username] = receiver_id
+
+        conversation_id = await database_sync_to_async(get_conversation_id)(self.user.id, receiver_id)
+        group_name = conversation_group_name(conversation_id)
         self.private_groups[receiver_username] = group_name
         
         await self.channel_layer.group_add(group_name, self.channel_name)
         logger.info(f"{self.user.username} started a chat with {receiver_username} in {group_name}")
 
+    async def handle_subscribe(self, data):
+        """Start receiving topics: presence, notifications, conversation:<username>"""
+        for topic in data.get('topics') or []:
+            topic = str(topic)
+            if topic == TOPIC_PRESENCE:
+                if topic not in self.topics:
+                    await self.channel_layer.group_add(self.lobby_group_name, self.channel_name)
+                await self.send_presence_snapshot()  # After joining, so no delta falls in between
+            elif topic == TOPIC_NOTIFICATIONS:
+                await self.send_unread_counts()
+            elif topic.startswith(CONVERSATION_TOPIC_PREFIX):
+                await self.handle_start_chat({'receiver': topic[len(CONVERSATION_TOPIC_PREFIX):]})
+                if topic[len(CONVERSATION_TOPIC_PREFIX):] not in self.private_groups:
+                    continue
+            else:
+                logger.warning(f"{self.user.username} asked for unknown topic {topic!r}")
+                continue
+            self.topics.add(topic)
+
+    async def handle_unsubscribe(self, data):
+        """Stop receiving topics"""
+        for topic in data.get('topics') or []:
+            topic = str(topic)
+            if topic not in self.topics:
+                continue
+            self.topics.discard(topic)
+            if topic == TOPIC_PRESENCE:
+                await self.channel_layer.group_discard(self.lobby_group_name, self.channel_name)
+            elif topic.startswith(CONVERSATION_TOPIC_PREFIX):
+                await self.leave_chat(topic[len(CONVERSATION_TOPIC_PREFIX):])
+
+    async def leave_chat(self, receiver_username):
+        """Stop typing in a chat and leave its group"""
+        await self.set_typing(receiver_username, False)
+        group_name = self.private_groups.pop(receiver_username, None)
+        if group_name is not None:
+            await self.channel_layer.group_discard(group_name, self.channel_name)
+
+    async def handle_ping(self, data):
+        """Client heartbeat: keep this socket counted as online"""
+        await get_heartbeat_store().beat(self.user.id, self.channel_name, settings.PRESENCE_TTL)
+        await self.send_event({'type': 'pong'})
+
+    async def handle_presence_sync(self, data):
+        """Client noticed a gap in presence deltas and wants a fresh snapshot"""
+        logger.debug(f"{self.user.username} requested a presence resync (last seq {data.get('seq')})")
+        await self.send_presence_snapshot()
+
+    async def handle_resume(self, data):
+        """Reconnected client: replay every message after the last id it saw, in one frame"""
+        try:
+            since = int(data.get('since', 0))
+        except (TypeError, ValueError):
+            logger.warning(f"{self.user.username} sent an invalid resume id: {data.get('since')!r}")
+            return
+
+        other_user_id = None
+        if data.get('receiver'):
+            other_user_id = await user_directory.resolve(data['receiver'])
+            if other_user_id is None:
+                logger.error(f"User {data['receiver']} doesn’t exist")
+                return
+
+        writer = get_message_writer()
+        if writer.batched:
+            await writer.flush()  # Buffered messages already went out with their ids
+        # Write-behind ids don't follow commit order across workers, replay by time with some overlap
+        overlap = timedelta(seconds=settings.CHAT_RESUME_OVERLAP) if writer.batched else None
+        messages, complete = await database_sync_to_async(get_messages_since)(
+            self.user, since, other_user_id, overlap=overlap
+        )
+        logger.debug(f"Replaying {len(messages)} messages after #{since} to {self.user.username}")
+        await self.send_event({
+            'type': 'resume',
+            'messages': [
+                self._message_event(message, message.sender.username, message.receiver.username)
+                for message in messages
+            ],
+            'complete': complete
+        })
+
+    async def handle_read(self, data):
+        """The user has seen messages from `receiver` up to `last_read_id`: move the watermark, tell the sender"""
+        sender_username = data.get('receiver')
+        try:
+            last_read_id = int(data.get('last_read_id'))
+        except (TypeError, ValueError):
+            logger.warning(f"{self.user.username} sent an invalid read watermark: {data.get('last_read_id')!r}")
+            return
+        if not sender_username:
+            logger.warning("No receiver specified")
+            return
+        sender_id = await user_directory.resolve(sender_username)
+        if sender_id is None:
+            logger.error(f"User {sender_username} doesn’t exist")
+            return
+
+        watermark = await database_sync_to_async(mark_read)(self.user.id, sender_id, last_read_id)
+        if watermark:
+            await send_read_receipt(self.channel_layer, self.user.username, sender_id, watermark)
+
     async def handle_chat_message(self, data):
-        """Send a message to a private chat group"""
-        from django.contrib.auth.models import User
-        
+        """Deliver a message to the recipient's sockets (and the sender's other tabs)"""
         message = data.get('message')
-        sender = data.get('sender', self.user.username)
+        sender = self.user.username  # Never trust a sender named in the frame
         receiver_username = data.get('receiver')
+        client_key = str(data.get('client_key') or '')[:64] or None  # Idempotency key for retried sends
 
-        if not receiver_username or receiver_username not in self.private_groups:
-            logger.warning(f"No chat group found for {receiver_username}")
+        if not receiver_username:
+            logger.warning("No receiver specified")
             return
+        if receiver_username not in self.recipients:
+            await self.handle_start_chat({'receiver': receiver_username})
 
-        try:
-            receiver = await database_sync_to_async(User.objects.get)(username=receiver_username)
-            message_obj = await self.save_message(message, receiver)
-
-            # Broadcast to the lobby that there's a new unread message (for UI updates)
-            await self.channel_layer.group_send(self.lobby_group_name, {
-                'type': 'unread_message_update',
-                'sender': sender,
-                'receiver': receiver_username
-            })
-
-            group_name = self.private_groups[receiver_username]
-            await self.channel_layer.group_send(group_name, {
-                'type': 'chat_message',
-                'message': message,
-                'sender': sender,
-                'timestamp': message_obj.timestamp.isoformat()
-            })
-        except User.DoesNotExist:
+        receiver_id = await self.get_recipient_id(receiver_username)
+        if receiver_id is None:
             logger.error(f"User {receiver_username} doesn’t exist")
+            return
+
+        writer = get_message_writer()
+        if client_key:
+            existing = await writer.find(self.user.id, client_key)
+            if existing is not None:
+                # Stored by an earlier attempt, only confirm it to this client
+                await self.send_event(self._message_event(existing, sender, receiver_username))
+                return
+
+        message_obj, created = await self.save_message(message, receiver_id, client_key)
+        if not created:
+            await self.send_event(self._message_event(message_obj, sender, receiver_username))
+            return
+        receiver_group = user_group_name(receiver_id)
+        await self.set_typing(receiver_username, False)  # Sending a message ends typing
+
+        # Let the recipient know there's a new unread message (for UI updates)
+        await group_send(self.channel_layer, receiver_group, {
+            'type': 'unread_message_update',
+            'sender': sender,
+            'receiver': receiver_username
+        })
+
+        event = self._message_event(message_obj, sender, receiver_username)
+        for group_name in {receiver_group, self.user_group_name}:
+            await group_send(self.channel_layer, group_name, event)
+
+    async def get_recipient_id(self, username):
+        """Recipient id cached on this connection, re-checked only after a user rename/delete"""
+        if self.recipients_generation != user_directory.generation:
+            self.recipients_generation = user_directory.generation
+            for name in list(self.recipients):
+                user_id = await user_directory.resolve(name)
+                if user_id is None:
+                    del self.recipients[name]
+                else:
+                    self.recipients[name] = user_id
+        return self.recipients.get(username)
     
     async def unread_message_update(self,event):
         """send unread message update to client """
-        await self.send(text_data=json.dumps(
+        if TOPIC_NOTIFICATIONS not in self.topics:
+            return
+        await self.send_event(
             {
                 'type' :'unread_message_update',
                 'sender': event['sender'],
                 'receiver':event['receiver']
             }
-        ))
+        )
 
     async def handle_typing(self, data):
-        """Show typing indicators in private chats"""
-        is_typing = data.get('is_typing', False)
-        sender = self.user.username
+        """Show typing indicators in private chats, forwarding only state changes"""
+        is_typing = bool(data.get('is_typing', False))
         receiver_username = data.get('receiver')
 
         if not receiver_username:
@@ -136,134 +324,148 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if receiver_username not in self.private_groups:
             # Initialize the chat group if it doesn't exist
             await self.handle_start_chat({'receiver': receiver_username})
+            if receiver_username not in self.private_groups:
+                return
+
+        await self.set_typing(receiver_username, is_typing)
+
+    async def set_typing(self, receiver_username, is_typing):
+        """
+        Track typing state per conversation and tell the group only when it flips.
+
+        Repeated "still typing" frames just push the expiry back, so a client
+        may keep sending them on every keystroke and never send a stop.
+        """
+        loop = asyncio.get_running_loop()
+        already_typing = receiver_username in self.typing_tasks
+
+        if is_typing:
+            self.typing_deadlines[receiver_username] = loop.time() + settings.CHAT_TYPING_TIMEOUT
+            if already_typing:
+                return
+            self.typing_tasks[receiver_username] = asyncio.create_task(self._expire_typing(receiver_username))
+        else:
+            if not already_typing:
+                return
+            task = self.typing_tasks.pop(receiver_username)
+            self.typing_deadlines.pop(receiver_username, None)
+            if task is not asyncio.current_task():
+                task.cancel()
 
         group_name = self.private_groups[receiver_username]
-        await self.channel_layer.group_send(group_name, {
+        await group_send(self.channel_layer, group_name, {
             'type': 'typing_indicator',
-            'sender': sender,
+            'sender': self.user.username,
             'is_typing': is_typing
         })
-        logger.debug(f"{sender} is typing: {is_typing} in {group_name}")
+        logger.debug(f"{self.user.username} is typing: {is_typing} in {group_name}")
+
+    async def _expire_typing(self, receiver_username):
+        """Stop the typing indicator once no typing frame arrived for CHAT_TYPING_TIMEOUT"""
+        loop = asyncio.get_running_loop()
+        while (delay := self.typing_deadlines.get(receiver_username, 0) - loop.time()) > 0:
+            await asyncio.sleep(delay)
+        await self.set_typing(receiver_username, False)
 
     async def chat_message(self, event):
         """Relay chat messages to the client"""
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'chat_message',
+            'id': event['id'],
             'message': event['message'],
             'sender': event['sender'],
-            'timestamp': event['timestamp']
-        }))
+            'receiver': event['receiver'],
+            'timestamp': event['timestamp'],
+            'client_key': event.get('client_key')
+        })
 
     async def typing_indicator(self, event):
         """Relay typing indicators to the client"""
-        await self.send(text_data=json.dumps({
+        await self.send_event({
             'type': 'typing_indicator',
             'sender': event['sender'],
             'is_typing': event['is_typing']
-        }))
-
-    async def user_list_update(self, event):
-        """Send the updated user list to the client"""
-        users = await self.get_all_users()
-        logger.debug(f"Sending user list to {self.user.username}: {users}")
-        await self.send(text_data=json.dumps({
-            'type': 'user_list',
-            'users': users,
-            'timestamp': datetime.now().isoformat()
-        }))
-
-    async def send_user_list(self):
-        """Send the initial user list to the newly connected client"""
-        users = await self.get_all_users()
-        logger.debug(f"Initial user list for {self.user.username}: {users}")
-        await self.send(text_data=json.dumps({
-            'type': 'user_list',
+        })
+
+    async def read_receipt(self, event):
+        """Relay how far a peer has read this user's messages"""
+        await self.send_event({
+            'type': 'read_receipt',
+            'reader': event['reader'],
+            'last_read_id': event['last_read_id']
+        })
+
+    async def presence_changed(self, event):
+        """Relay a single user's online/offline change to the client"""
+        await self.send_event({
+            'type': 'presence_changed',
+            'username': event['username'],
+            'is_online': event['is_online'],
+            'seq': event['seq']
+        })
+
+    async def send_event(self, event):
+        """Queue one event for the client, never waits for the socket (see chatapp/outbound.py)"""
+        self.outbound.put(event)
+
+    async def send_events(self, events):
+        """Write queued events in the negotiated wire format, one binary frame for batching codecs"""
+        if self.codec.batched:
+            await self.send(bytes_data=self.codec.encode(events))
+            return
+        for event in events:
+            await self.send(text_data=self.codec.encode([event]))
+
+    def on_outbound_overflow(self, reason):
+        """The client can't keep up: close it, it reconnects and catches up with `resume`"""
+        logger.warning(f"Closing slow client {self.user.username} ({reason}, {len(self.outbound)} events queued)")
+        WS_SLOW_CLIENT_DISCONNECTS.inc(reason=reason)
+        self.close_task = asyncio.create_task(self.close(code=SLOW_CLIENT_CLOSE_CODE))
+
+    async def send_presence_snapshot(self):
+        """Send the full user list to this client only"""
+        seq, users = await get_presence_snapshot()
+        logger.debug(f"Presence snapshot #{seq} for {self.user.username}: {users}")
+        await self.send_event({
+            'type': 'presence_snapshot',
             'users': users,
+            'seq': seq,
             'timestamp': datetime.now().isoformat()
-        }))
-
-    @database_sync_to_async
-    def update_user_status(self, status):
-        """Update the user’s online status in the database"""
-        from .models import UserProfile
-        try:
-            profile, created = UserProfile.objects.get_or_create(user=self.user, defaults={'is_online': status})
-            if not created:
-                old_status = profile.is_online
-                profile.is_online = status
-                profile.save()
-                logger.info(f"{self.user.username} status changed: {old_status} -> {status}")
-            else:
-                logger.info(f"Created profile for {self.user.username} with status {status}")
-            return profile.is_online
-        except Exception as e:
-            logger.error(f"Failed to update {self.user.username} status: {str(e)}")
-            return False
-
-    @database_sync_to_async
-    def save_message(self, content, receiver):
-        """Save a chat message to the database"""
-        from .models import Message
-        return Message.objects.create(
-            sender=self.user,
-            receiver=receiver,
-            content=content
-        )
+        })
 
-    @database_sync_to_async
-    def get_all_users(self):
-        """Get a list of all users and their online status"""
-        from django.contrib.auth.models import User
-        from .models import UserProfile
-        users = User.objects.exclude(is_superuser=True)  # Exclude superusers if desired
-        user_list = []
-        for user in users:
-            try:
-                profile = UserProfile.objects.get(user=user)
-                is_online = profile.is_online
-            except UserProfile.DoesNotExist:
-                is_online = False
-            user_list.append({
-                'username': user.username,
-                'is_online': is_online
-            })
-        logger.debug(f"User list fetched: {user_list}")
-        return user_list
-
-    def _generate_group_name(self, other_username):
-        """Create a unique name for private chat groups"""
-        user1 = self.user.username.replace(' ', '_').lower()
-        user2 = other_username.replace(' ', '_').lower()
-        return f"chat_{min(user1, user2)}_{max(user1, user2)}"
-
-    async def _broadcast_user_list_update(self):
-        """Notify all connected users of an updated user list"""
-        logger.debug(f"Broadcasting user list update to {self.lobby_group_name}")
-        await self.channel_layer.group_send(self.lobby_group_name, {
-            'type': 'user_list_update'
+    async def send_unread_counts(self):
+        """Push the current unread counters so the client needs no HTTP round trip"""
+        counts = await database_sync_to_async(get_unread_counts)(self.user.id)
+        await self.send_event({
+            'type': 'unread_counts',
+            'counts': counts
         })
 
+    async def save_message(self, content, receiver_id, client_key=None):
+        """Save a chat message (right away or write-behind, see CHAT_MESSAGE_DURABILITY)"""
+        return await get_message_writer().save(self.user, receiver_id, content, client_key)
+
+    @staticmethod
+    def _message_event(message, sender, receiver):
+        """chat_message event for a saved message"""
+        return {
+            'type': 'chat_message',
+            'id': message.id,
+            'message': message.content,
+            'sender': sender,
+            'receiver': receiver,
+            'timestamp': message.timestamp.isoformat(),
+            'client_key': message.client_key
+        }
+
 # Signal handler for Django logout
 @receiver(user_logged_out)
 def update_user_status_on_logout(sender, user, request, **kwargs):
-    """Update user status and notify others when a user logs out"""
-    from channels.layers import get_channel_layer
-    from .models import UserProfile
-    
+    """Forget the user's heartbeats on logout, the next presence flush marks them offline"""
+    if user is None:
+        return
     try:
-        profile, created = UserProfile.objects.get_or_create(user=user, defaults={'is_online': False})
-        if not created and profile.is_online:
-            profile.is_online = False
-            profile.save()
-            logger.info(f"{user.username} logged out, status updated to offline")
-
-            # Broadcast the update to all connected clients
-            channel_layer = get_channel_layer()
-            if channel_layer:
-                async def broadcast():
-                    await channel_layer.group_send('chat_lobby', {
-                        'type': 'user_list_update'
-                    })
-                async_to_sync(broadcast)()
+        get_heartbeat_store().drop_user_sync(user.id)
+        logger.info(f"{user.username} logged out, heartbeats dropped")
     except Exception as e:
-        logger.error(f"Error handling logout for {user.username}: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error handling logout for {user.username}: {str(e)}")
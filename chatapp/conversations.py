@@ -0,0 +1,95 @@
+# chatapp/conversations.py
+"""
+Conversation bookkeeping.
+
+Every saved message bumps its Conversation row (last message, last
+activity and the receiver's unread count) with one UPDATE in the same
+transaction as the INSERT, so inbox listings and unread badges never need
+to scan Message. Conversation ids are also the stable key of the channel
+group a chat's typing indicators go through.
+"""
+import logging
+from collections import defaultdict
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from .unread import invalidate_unread_counts
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _conversation_key(pair):
+    return f"conversation:{pair['user_low_id']}:{pair['user_high_id']}"
+
+
+def get_conversation_id(user_id, other_id):
+    """Id of the conversation between two users, created on first use and cached"""
+    from .models import Conversation
+    pair = Conversation.pair(user_id, other_id)
+    key = _conversation_key(pair)
+    conversation_id = cache.get(key)
+    if conversation_id is None:
+        conversation_id = Conversation.objects.get_or_create(**pair)[0].id
+        cache.set(key, conversation_id, CONVERSATION_CACHE_TIMEOUT)
+    return conversation_id
+
+
+def find_conversation_id(user_id, other_id):
+    """Id of the conversation between two users or None if they never talked, for read-only paths"""
+    from .models import Conversation
+    pair = Conversation.pair(user_id, other_id)
+    key = _conversation_key(pair)
+    conversation_id = cache.get(key)
+    if conversation_id is None:
+        conversation_id = Conversation.objects.filter(**pair).values_list('id', flat=True).first()
+        if conversation_id is not None:  # A miss isn't cached, the first message creates the row
+            cache.set(key, conversation_id, CONVERSATION_CACHE_TIMEOUT)
+    return conversation_id
+
+
+def record_new_messages(messages):
+    """Update the conversations a batch of freshly saved messages belong to (one UPDATE per pair)"""
+    from .models import Conversation
+    batches = defaultdict(list)
+    for message in messages:
+        batches[tuple(sorted((message.sender_id, message.receiver_id)))].append(message)
+
+    for (low, high), batch in batches.items():
+        newest = max(batch, key=lambda message: message.id)
+        unread = {'low': 0, 'high': 0}
+        for message in batch:
+            if message.receiver_id != message.sender_id:
+                unread[Conversation.side(message.receiver_id, message.sender_id)] += 1
+
+        # Greatest keeps the metadata right when write-behind batches land out of order
+        updates = {
+            'last_message_id': Greatest(Coalesce(models.F('last_message_id'), 0), newest.id),
+            'last_activity': Greatest(Coalesce(models.F('last_activity'), newest.timestamp), newest.timestamp),
+        }
+        updates.update({f'{side}_unread': models.F(f'{side}_unread') + count
+                        for side, count in unread.items() if count})
+        conversations = Conversation.objects.filter(user_low_id=low, user_high_id=high)
+        if not conversations.update(**updates):
+            try:
+                with transaction.atomic():
+                    Conversation.objects.create(
+                        user_low_id=low, user_high_id=high,
+                        last_message_id=newest.id, last_activity=newest.timestamp,
+                        low_unread=unread['low'], high_unread=unread['high']
+                    )
+            except IntegrityError:
+                # Someone else created it in the meantime
+                conversations.update(**updates)
+
+        for receiver_id in {message.receiver_id for message in batch if message.receiver_id != message.sender_id}:
+            invalidate_unread_counts(receiver_id)
+
+
+@receiver(post_save, sender='chatapp.Message')
+def _record_new_message(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_new_messages([instance])
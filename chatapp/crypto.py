@@ -0,0 +1,135 @@
+# chatapp/crypto.py
+"""
+Message encryption.
+
+The keyring comes from settings.MESSAGE_ENCRYPTION_KEYS, a list of
+(key_id, secret) pairs. The first key encrypts new messages and every key can
+decrypt. New ciphertexts are stored as "<key_id>:<fernet token>" so reads go
+straight to the right key. Older bare tokens fall back to trying every key.
+
+Ciphers are built once per process and reused. decrypt_many() decrypts a
+whole page: it reads the keyring once, groups the values by key id and runs
+each group through its own cipher.
+
+search_token() derives the blind index tokens message search is built on:
+an HMAC of a normalized word under settings.MESSAGE_SEARCH_KEY, salted with
+the conversation id so equal words in different conversations never share
+a token.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import time
+from functools import lru_cache
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+KEY_ID_SEPARATOR = ':'  # Never part of a Fernet token (urlsafe base64)
+SEARCH_TOKEN_BYTES = 16  # Truncated HMAC, plenty to keep collisions out of result pages
+
+
+def derive_fernet_key(secret):
+    """Turn an arbitrary secret string into a 32-byte urlsafe Fernet key"""
+    # Use SHA256 to ensure we get exactly 32 bytes
+    key_bytes = hashlib.sha256(secret.encode()).digest()
+    return base64.urlsafe_b64encode(key_bytes)
+
+
+@lru_cache(maxsize=None)
+def get_keyring():
+    """Return (primary key id, {key_id: Fernet}) built once per process"""
+    keys = settings.MESSAGE_ENCRYPTION_KEYS
+    if not keys:
+        raise ValueError("MESSAGE_ENCRYPTION_KEYS must contain at least one key")
+    ciphers = {key_id: Fernet(derive_fernet_key(secret)) for key_id, secret in keys}
+    return keys[0][0], ciphers
+
+
+@lru_cache(maxsize=None)
+def get_cipher():
+    """MultiFernet over the whole keyring, used for tokens without a key id"""
+    primary_id, ciphers = get_keyring()
+    ordered = [ciphers[primary_id]] + [c for key_id, c in ciphers.items() if key_id != primary_id]
+    return MultiFernet(ordered)
+
+
+@lru_cache(maxsize=None)
+def get_search_key():
+    """HMAC key for search tokens, separate from the encryption keys"""
+    return hashlib.sha256(b'zeenchat-search:' + settings.MESSAGE_SEARCH_KEY.encode()).digest()
+
+
+@receiver(setting_changed)
+def _reset_keyring(setting, **kwargs):
+    if setting in ('MESSAGE_ENCRYPTION_KEYS', 'MESSAGE_SEARCH_KEY', 'SECRET_KEY'):
+        get_keyring.cache_clear()
+        get_cipher.cache_clear()
+        get_search_key.cache_clear()
+
+
+def encrypt(raw_text):
+    """Encrypt text with the primary key, tagging the token with its key id"""
+    primary_id, ciphers = get_keyring()
+    token = ciphers[primary_id].encrypt(raw_text.encode()).decode()
+    return f"{primary_id}{KEY_ID_SEPARATOR}{token}"
+
+
+def decrypt(stored):
+    """
+    Decrypt one stored value.
+
+    Values that are not valid tokens for any key are returned unchanged: this
+    keeps rows written before encryption was introduced readable.
+    """
+    if not stored:
+        return ""
+    key_id, separator, token = stored.partition(KEY_ID_SEPARATOR)
+    cipher = get_keyring()[1].get(key_id) if separator else None
+    if cipher is None:
+        # Bare token from before key ids were stored (or plain legacy text)
+        return _decrypt_with(get_cipher(), stored, stored)
+    return _decrypt_with(cipher, token, stored)
+
+
+def _decrypt_with(cipher, token, stored):
+    try:
+        return cipher.decrypt(token.encode()).decode()
+    except InvalidToken:
+        logger.warning("Could not decrypt message content, serving it as stored")
+        return stored
+
+
+def decrypt_many(values):
+    """Decrypt a batch of stored values, returning the plaintexts in the same order"""
+    started = time.perf_counter()
+    ciphers = get_keyring()[1]
+    plaintexts = [""] * len(values)
+    groups = {}  # key id (None for bare tokens) -> [(position, token, stored value)]
+    for position, stored in enumerate(values):
+        if not stored:
+            continue
+        key_id, separator, token = stored.partition(KEY_ID_SEPARATOR)
+        if separator and key_id in ciphers:
+            groups.setdefault(key_id, []).append((position, token, stored))
+        else:
+            groups.setdefault(None, []).append((position, stored, stored))
+    for key_id, items in groups.items():
+        cipher = ciphers[key_id] if key_id is not None else get_cipher()
+        for position, token, stored in items:
+            plaintexts[position] = _decrypt_with(cipher, token, stored)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if plaintexts:
+        logger.debug(f"Decrypted {len(plaintexts)} messages in {elapsed_ms:.2f}ms "
+                     f"({elapsed_ms / len(plaintexts):.3f}ms each)")
+    return plaintexts
+
+
+def search_token(conversation_id, word):
+    """Blind index token for one normalized word of a conversation"""
+    digest = hmac.new(get_search_key(), f"{conversation_id}:{word}".encode(), hashlib.sha256).digest()
+    return digest[:SEARCH_TOKEN_BYTES]
@@ -0,0 +1,45 @@
+# chatapp/db.py
+"""
+Database access from async code.
+
+Django's async ORM methods (aget, acreate, ...) are still sync_to_async with
+thread_sensitive=True underneath, so every socket's queries queue behind a
+single worker thread. database_sync_to_async here runs each hop on a pool of
+DB_THREAD_POOL_SIZE threads instead (one connection per thread, reused when
+PG_CONN_MODE enables persistent or pooled connections) and records how long
+callers waited for it. With DB_THREAD_POOL_SIZE=0 it behaves like channels'
+helper.
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from .metrics import DB_HOP_SECONDS
+
+_executor = None
+
+
+def get_db_executor():
+    """Shared executor for database hops, None to use asgiref's thread-sensitive thread"""
+    global _executor
+    size = getattr(settings, 'DB_THREAD_POOL_SIZE', 0)
+    if size and _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='zeenchat-db')
+    return _executor
+
+
+def database_sync_to_async(func):
+    """Drop-in for channels' database_sync_to_async: pooled threads, timed hops"""
+    name = getattr(func, '__qualname__', None) or type(func).__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        executor = get_db_executor()
+        if executor is None:
+            hop = DatabaseSyncToAsync(func)
+        else:
+            # Every hop is self-contained (no transaction spans two calls), so any thread will do
+            hop = DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor)
+        with DB_HOP_SECONDS.time(function=name):
+            return await hop(*args, **kwargs)
+    return wrapper
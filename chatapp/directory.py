@@ -0,0 +1,90 @@
+# chatapp/directory.py
+"""
+Process-wide username -> user id cache.
+
+ChatConsumer resolves a recipient once per chat session and keeps the id on
+the connection; this bounded LRU is what those resolutions share. Renaming
+or deleting a user drops its entry and bumps `generation`, which tells
+connections that their own cached ids need a re-check. Entries also expire
+after USER_DIRECTORY_TTL as a backstop for changes made by other processes.
+"""
+import logging
+import time
+from collections import OrderedDict
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .db import database_sync_to_async
+
+logger = logging.getLogger(__name__)
+
+USER_DIRECTORY_SIZE = 10000
+USER_DIRECTORY_TTL = 300  # seconds
+
+
+class UserDirectory:
+    """Bounded LRU of username -> user id"""
+
+    def __init__(self, max_size=USER_DIRECTORY_SIZE, ttl=USER_DIRECTORY_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()  # username -> (user_id, expires_at)
+
+    def get(self, username):
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        user_id, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[username]
+            return None
+        self._entries.move_to_end(username)
+        return user_id
+
+    def put(self, username, user_id):
+        self._entries[username] = (user_id, time.monotonic() + self.ttl)
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Forget every username that pointed at this user"""
+        stale = [name for name, (cached_id, _) in self._entries.items() if cached_id == user_id]
+        for name in stale:
+            del self._entries[name]
+        self.generation += 1
+
+    def lookup(self, username):
+        """Synchronous resolve for views"""
+        user_id = self.get(username)
+        if user_id is None:
+            user_id = User.objects.filter(username=username).values_list('id', flat=True).first()
+            if user_id is not None:
+                self.put(username, user_id)
+        return user_id
+
+    async def resolve(self, username):
+        """Return the id for a username (None if there is no such user)"""
+        user_id = self.get(username)
+        if user_id is None:
+            user_id = await database_sync_to_async(
+                User.objects.filter(username=username).values_list('id', flat=True).first
+            )()
+            if user_id is not None:
+                self.put(username, user_id)
+        return user_id
+
+
+user_directory = UserDirectory()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _invalidate_user(sender, instance, **kwargs):
+    """Renames and deletes must not leave a username pointing at the wrong id"""
+    update_fields = kwargs.get('update_fields')
+    if kwargs.get('created') or (update_fields is not None and 'username' not in update_fields):
+        return  # e.g. the last_login update on every login
+    user_directory.invalidate(instance.pk)
+    logger.debug(f"Dropped cached directory entries for user {instance.pk}")
@@ -0,0 +1,127 @@
+# chatapp/export.py
+"""
+Streaming conversation exports.
+
+An export walks one conversation (or every conversation of a user), oldest
+message first: the archived segments, then the live rows through a
+server-side cursor (QuerySet.iterator). Messages are decrypted and rendered
+EXPORT_CHUNK_SIZE at a time, so memory use stays flat however long the
+history is. The same generators back the /export/ view and
+`manage.py export_messages`.
+"""
+import asyncio
+import csv
+import io
+import json
+import threading
+from itertools import islice
+from django.db import connection, transaction
+from . import archive
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+EXPORT_FIELDS = ('id', 'timestamp', 'sender', 'receiver', 'content')
+EXPORT_QUEUE_BLOCKS = 4  # rendered chunks buffered between the export thread and the response
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def _conversations(user, other_user=None):
+    from .models import Conversation
+    if other_user is not None:
+        return Conversation.objects.filter(**Conversation.pair(user.id, other_user.id)).select_related(
+            'user_low', 'user_high'
+        )
+    return Conversation.involving(user).select_related('user_low', 'user_high').order_by('id')
+
+
+def iter_message_chunks(user, other_user=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Decrypted lists of at most chunk_size messages, conversation by conversation, oldest first"""
+    from .models import Message
+    for conversation in _conversations(user, other_user).iterator(chunk_size=100):
+        users = {conversation.user_low_id: conversation.user_low, conversation.user_high_id: conversation.user_high}
+        live = conversation.messages().order_by('timestamp', 'id').iterator(chunk_size=chunk_size)
+        for source in (archive.iter_messages(conversation.id), live):
+            for chunk in _chunks(source, chunk_size):
+                for message in chunk:
+                    message.sender, message.receiver = users[message.sender_id], users[message.receiver_id]
+                yield Message.decrypt_many(chunk)
+
+
+def _row(message):
+    return {
+        'id': message.pk,
+        'timestamp': message.timestamp.isoformat(),
+        'sender': message.sender.username,
+        'receiver': message.receiver.username,
+        'content': message.content,
+    }
+
+
+def render_chunk(chunk, export_format):
+    """One chunk of messages as a JSONL or CSV text block (CSV without the header)"""
+    if export_format == 'jsonl':
+        return ''.join(json.dumps(_row(message), ensure_ascii=False) + '\n' for message in chunk)
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, EXPORT_FIELDS).writerows(_row(message) for message in chunk)
+    return buffer.getvalue()
+
+
+def iter_export(user, other_user=None, export_format='jsonl', chunk_size=EXPORT_CHUNK_SIZE):
+    """The whole export as text blocks, header first for CSV"""
+    if export_format == 'csv':
+        yield ','.join(EXPORT_FIELDS) + '\r\n'
+    for chunk in iter_message_chunks(user, other_user, chunk_size):
+        yield render_chunk(chunk, export_format)
+
+
+async def aiter_export(user, other_user=None, export_format='jsonl', chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    iter_export for StreamingHttpResponse under ASGI, which would otherwise buffer a sync iterator whole.
+
+    The export runs on an executor thread with its own database connection
+    and transaction. Request signals on asgiref's shared sync thread can't
+    close the server-side cursor under it, and decrypting doesn't hold that
+    thread up. Rendered blocks come back through a small queue, so the
+    thread never runs far ahead of a slow client.
+    """
+    loop = asyncio.get_running_loop()
+    blocks = asyncio.Queue(maxsize=EXPORT_QUEUE_BLOCKS)
+    stopped = threading.Event()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(blocks.put(item), loop).result()
+
+    def produce():
+        try:
+            with transaction.atomic():
+                for block in iter_export(user, other_user, export_format, chunk_size):
+                    if stopped.is_set():
+                        return
+                    put(block)
+        except Exception as e:
+            put(e)
+        finally:
+            connection.close()  # This thread's connection, the executor may hand the thread to anyone next
+            put(None)
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while (block := await blocks.get()) is not None:
+            if isinstance(block, Exception):
+                raise block
+            yield block.encode('utf-8')
+    finally:
+        # Client gone or export done: let the thread finish its last put and wind down
+        stopped.set()
+        while not producer.done():
+            while not blocks.empty():
+                blocks.get_nowait()
+            await asyncio.wait({producer}, timeout=0.1)
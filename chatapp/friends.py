@@ -0,0 +1,57 @@
+# chatapp/friends.py
+"""
+Friend graph lookups for the users page.
+
+Accepted friendships live in the Friendship table with both directions
+stored, so "friends of X" is one index range on (user, friend). Each user's
+friends and open requests are cached together as sets of user ids; the
+friend request views invalidate both users involved whenever something
+changes.
+"""
+from django.core.cache import cache
+from django.db import transaction
+
+FRIEND_GRAPH_CACHE_TIMEOUT = 60 * 60
+
+
+def _cache_key(user_id):
+    return f'friends:{user_id}'
+
+
+def get_friend_graph(user_id):
+    """
+    Return {'friends', 'incoming', 'outgoing'} sets of user ids for one user.
+
+    incoming are pending requests sent to the user, outgoing every request
+    the user has sent (a declined one is deleted, so it no longer counts).
+    """
+    from .models import FriendRequest, Friendship
+    key = _cache_key(user_id)
+    graph = cache.get(key)
+    if graph is None:
+        graph = {
+            'friends': set(Friendship.objects.filter(user_id=user_id).values_list('friend_id', flat=True)),
+            'incoming': set(FriendRequest.objects.filter(
+                receiver_id=user_id, status=FriendRequest.Status.PENDING
+            ).values_list('sender_id', flat=True)),
+            'outgoing': set(FriendRequest.objects.filter(sender_id=user_id).values_list('receiver_id', flat=True)),
+        }
+        cache.set(key, graph, FRIEND_GRAPH_CACHE_TIMEOUT)
+    return graph
+
+
+def invalidate_friend_graph(*user_ids):
+    cache.delete_many([_cache_key(user_id) for user_id in user_ids])
+
+
+def add_friendship(request_obj):
+    """Accept a friend request: mark it accepted and store both directions of the friendship"""
+    from .models import FriendRequest, Friendship
+    with transaction.atomic():
+        request_obj.status = FriendRequest.Status.ACCEPTED
+        request_obj.save(update_fields=['status'])
+        Friendship.objects.bulk_create([
+            Friendship(user_id=request_obj.sender_id, friend_id=request_obj.receiver_id),
+            Friendship(user_id=request_obj.receiver_id, friend_id=request_obj.sender_id),
+        ], ignore_conflicts=True)
+    invalidate_friend_graph(request_obj.sender_id, request_obj.receiver_id)
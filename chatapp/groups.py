@@ -0,0 +1,14 @@
+# chatapp/groups.py
+"""Channel-layer group names shared by the consumer and the HTTP views"""
+
+PRESENCE_GROUP = 'chat_lobby'  # Sockets subscribed to presence listen here for deltas
+
+
+def user_group_name(user_id):
+    """Every socket of one user joins this group, direct deliveries go here"""
+    return f"user_{user_id}"
+
+
+def conversation_group_name(conversation_id):
+    """Sockets that have a chat open join this group, typing indicators go here"""
+    return f"conversation_{conversation_id}"
@@ -0,0 +1,215 @@
+# chatapp/heartbeats.py
+"""
+Heartbeat-based presence.
+
+Every socket keeps an entry in a heartbeat store that expires PRESENCE_TTL
+seconds after its last beat. Sockets beat on connect and on every client
+`ping`, and remove their entry on disconnect. A user is online while any of
+their entries is alive, so a worker that dies without running disconnect
+only leaves entries that expire on their own.
+
+Sockets never write presence to the database. Every PRESENCE_FLUSH_INTERVAL
+seconds one worker (whoever takes the cache lock) compares the live users
+with UserProfile.is_online. It writes the difference with bulk UPDATEs and
+broadcasts a presence delta for each user that changed. last_seen of online
+users is refreshed at most every PRESENCE_LAST_SEEN_INTERVAL seconds, so the
+write rate follows the number of online users, not connection churn.
+
+settings.PRESENCE_BACKEND picks the store: "redis" (one sorted set shared by
+all workers, scored by expiry time) or "local" (in-process, for a single
+worker and tests).
+"""
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from weakref import WeakKeyDictionary
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+from .db import database_sync_to_async
+from .presence import broadcast_presence_change
+
+logger = logging.getLogger(__name__)
+
+HEARTBEATS_KEY = 'presence:heartbeats'
+FLUSH_LOCK_KEY = 'presence:flush-lock'
+
+
+def _member(user_id, connection_id):
+    return f'{user_id}:{connection_id}'
+
+
+def _user_ids(members):
+    return {int(member.split(':', 1)[0]) for member in members}
+
+
+class LocalHeartbeatStore:
+    """Heartbeats of this process only"""
+
+    def __init__(self):
+        self._expiry = {}  # member -> expiry time
+
+    async def beat(self, user_id, connection_id, ttl):
+        self._expiry[_member(user_id, connection_id)] = time.time() + ttl
+
+    async def drop(self, user_id, connection_id):
+        self._expiry.pop(_member(user_id, connection_id), None)
+
+    async def drop_user(self, user_id):
+        self.drop_user_sync(user_id)
+
+    def drop_user_sync(self, user_id):
+        for member in [m for m in self._expiry if m.startswith(f'{user_id}:')]:
+            del self._expiry[member]
+
+    async def online_user_ids(self):
+        """Ids of users with a live heartbeat, expired entries are pruned on the way"""
+        now = time.time()
+        self._expiry = {member: expiry for member, expiry in self._expiry.items() if expiry > now}
+        return _user_ids(self._expiry)
+
+
+class RedisHeartbeatStore:
+    """Heartbeats of every worker in one Redis sorted set (member "<user id>:<channel>", score = expiry)"""
+
+    def __init__(self, url):
+        self.url = url
+        self._clients = WeakKeyDictionary()  # event loop -> client, redis.asyncio clients are bound to one loop
+        self._sync_client = None  # For sync callers (logout), thread-safe and shared
+
+    def _client(self):
+        import redis.asyncio
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+        return client
+
+    async def beat(self, user_id, connection_id, ttl):
+        await self._client().zadd(HEARTBEATS_KEY, {_member(user_id, connection_id): time.time() + ttl})
+
+    async def drop(self, user_id, connection_id):
+        await self._client().zrem(HEARTBEATS_KEY, _member(user_id, connection_id))
+
+    async def drop_user(self, user_id):
+        client = self._client()
+        members = [member async for member, _ in client.zscan_iter(HEARTBEATS_KEY, match=f'{user_id}:*')]
+        if members:
+            await client.zrem(HEARTBEATS_KEY, *members)
+
+    def drop_user_sync(self, user_id):
+        """drop_user for sync code, without an event loop (and a new connection) per call"""
+        if self._sync_client is None:
+            import redis
+            self._sync_client = redis.Redis.from_url(self.url, decode_responses=True)
+        members = [member for member, _ in self._sync_client.zscan_iter(HEARTBEATS_KEY, match=f'{user_id}:*')]
+        if members:
+            self._sync_client.zrem(HEARTBEATS_KEY, *members)
+
+    async def online_user_ids(self):
+        """Ids of users with a live heartbeat, expired entries are pruned on the way"""
+        async with self._client().pipeline(transaction=True) as pipe:
+            now = time.time()
+            pipe.zremrangebyscore(HEARTBEATS_KEY, '-inf', now)
+            pipe.zrange(HEARTBEATS_KEY, 0, -1)
+            _, members = await pipe.execute()
+        return _user_ids(members)
+
+
+_store = None
+
+
+def get_heartbeat_store():
+    """The heartbeat store of this process, built on first use"""
+    global _store
+    if _store is None:
+        if settings.PRESENCE_BACKEND == 'redis':
+            _store = RedisHeartbeatStore(settings.PRESENCE_REDIS_URL)
+        elif settings.PRESENCE_BACKEND == 'local':
+            _store = LocalHeartbeatStore()
+        else:
+            raise ValueError(f"Unknown PRESENCE_BACKEND {settings.PRESENCE_BACKEND!r}")
+    return _store
+
+
+@receiver(setting_changed)
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting in ('PRESENCE_BACKEND', 'PRESENCE_REDIS_URL'):
+        _store = None
+
+
+def write_presence(online_ids):
+    """
+    Make UserProfile match the live heartbeats, returns (usernames that came online, that went offline).
+
+    The same few statements whatever the number of users: the ids marked
+    online, one UPDATE for users now online (or with a stale last_seen), one
+    UPDATE for users who went offline, an INSERT for first-timers and the
+    usernames of whoever changed.
+    """
+    from django.contrib.auth.models import User
+    from .models import UserProfile
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.PRESENCE_LAST_SEEN_INTERVAL)
+    with transaction.atomic():
+        was_online = set(UserProfile.objects.filter(is_online=True).values_list('user_id', flat=True))
+        came_online, went_offline = online_ids - was_online, was_online - online_ids
+        if online_ids:
+            (UserProfile.objects.filter(user_id__in=online_ids)
+             .filter(Q(is_online=False) | Q(last_seen__lt=stale))
+             .update(is_online=True, last_seen=now))
+            if came_online:
+                # Users who never had a profile, the rest conflict and are skipped
+                UserProfile.objects.bulk_create(
+                    [UserProfile(user_id=user_id, is_online=True, last_seen=now) for user_id in came_online],
+                    ignore_conflicts=True
+                )
+        if went_offline:
+            UserProfile.objects.filter(user_id__in=went_offline).update(is_online=False, last_seen=now)
+
+    changed = came_online | went_offline
+    usernames = dict(User.objects.filter(id__in=changed).values_list('id', 'username')) if changed else {}
+    return ([usernames[i] for i in came_online if i in usernames],
+            [usernames[i] for i in went_offline if i in usernames])
+
+
+async def flush_presence(channel_layer):
+    """Write presence changes since the last flush and broadcast them, returns the number of changes"""
+    online_ids = await get_heartbeat_store().online_user_ids()
+    came_online, went_offline = await database_sync_to_async(write_presence)(online_ids)
+    for username in came_online:
+        await broadcast_presence_change(channel_layer, username, True)
+    for username in went_offline:
+        await broadcast_presence_change(channel_layer, username, False)
+    if came_online or went_offline:
+        logger.info(f"Presence flush: {len(came_online)} online, {len(went_offline)} offline")
+    return len(came_online) + len(went_offline)
+
+
+async def _flush_forever(channel_layer):
+    interval = settings.PRESENCE_FLUSH_INTERVAL
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # One worker per interval does the flush, the lock expires before the next round
+            if await cache.aadd(FLUSH_LOCK_KEY, 1, timeout=max(int(interval * 0.9), 1)):
+                await flush_presence(channel_layer)
+        except Exception as e:
+            logger.error(f"Presence flush failed: {str(e)}")
+
+
+_flusher_task = None
+
+
+def ensure_presence_flusher(channel_layer):
+    """Start this worker's presence flusher if it isn't running yet"""
+    global _flusher_task
+    loop = asyncio.get_running_loop()
+    if _flusher_task is None or _flusher_task.done() or _flusher_task.get_loop() is not loop:
+        _flusher_task = loop.create_task(_flush_forever(channel_layer))
@@ -0,0 +1,79 @@
+# chatapp/history_cache.py
+"""
+Rendered history pages, cached.
+
+The page of messages before a cursor does not change once it exists: new
+messages only land on the newest page, and archiving moves rows without
+changing what a page shows. The rendered fragment of every older page is
+therefore cached under (conversation, generation, viewer, cursor), and the
+same key is the page's ETag. Scrolling back again is a 304; a page another
+tab or process already rendered is a cache hit. Neither reads a message or
+renders anything. The one query left is @login_required loading the
+request's User: the session itself comes from the cache (cached_db
+SESSION_ENGINE), the user row it points at does not.
+
+Changing or deleting a stored message bumps its conversation's generation,
+which retires every cached page of that conversation at once. Deletes
+include user-deletion cascades and archiving, which only costs a re-render.
+"""
+import hashlib
+import time
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .conversations import find_conversation_id, get_conversation_id
+from .pagination import HISTORY_PAGE_SIZE
+
+HISTORY_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def _generation_key(conversation_id):
+    return f'history:generation:{conversation_id}'
+
+
+def get_generation(conversation_id):
+    """Current generation of a conversation's pages, started on first use"""
+    key = _generation_key(conversation_id)
+    generation = cache.get(key)
+    if generation is None:
+        # A clock value rather than a counter, so an evicted generation never comes back
+        cache.add(key, time.time_ns(), None)
+        generation = cache.get(key)
+    return generation
+
+
+def invalidate_history(conversation_id):
+    """Retire every cached page of a conversation"""
+    cache.set(_generation_key(conversation_id), time.time_ns(), None)
+
+
+def page_key(conversation_id, viewer_id, cursor):
+    """Cache key of the page before `cursor` as rendered for `viewer_id`"""
+    digest = hashlib.sha256(cursor.encode()).hexdigest()[:32]
+    generation = get_generation(conversation_id)
+    return f'history:page:{conversation_id}:{generation}:{viewer_id}:{HISTORY_PAGE_SIZE}:{digest}'
+
+
+def page_etag(key):
+    return '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+
+def get_page(key):
+    return cache.get(key)
+
+
+def set_page(key, fragment):
+    cache.set(key, fragment, HISTORY_CACHE_TIMEOUT)
+
+
+@receiver(post_save, sender='chatapp.Message')
+def _invalidate_changed_message(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        invalidate_history(get_conversation_id(instance.sender_id, instance.receiver_id))
+
+
+@receiver(post_delete, sender='chatapp.Message')
+def _invalidate_deleted_message(sender, instance, **kwargs):
+    conversation_id = find_conversation_id(instance.sender_id, instance.receiver_id)
+    if conversation_id is not None:  # Gone too when the delete cascades from a user
+        invalidate_history(conversation_id)
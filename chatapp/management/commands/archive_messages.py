@@ -0,0 +1,57 @@
+# chatapp/management/commands/archive_messages.py
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from chatapp import archive
+from chatapp.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = "Move messages older than a cutoff out of the database into compressed archive segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=180, metavar='DAYS',
+                            help="Archive messages sent more than this many days ago")
+        parser.add_argument('--segment-size', type=int, default=5000,
+                            help="Messages per segment file")
+
+    def handle(self, *args, **options):
+        if options['older_than'] < 1 or options['segment_size'] < 1:
+            raise CommandError("--older-than and --segment-size must be positive")
+        cutoff = timezone.now() - timedelta(days=options['older_than'])
+
+        archived = conversations = 0
+        for conversation in Conversation.objects.order_by('id').iterator(chunk_size=500):
+            self._finish_interrupted_run(conversation)
+            count = self._archive_conversation(conversation, cutoff, options['segment_size'])
+            if count:
+                archived += count
+                conversations += 1
+                self.stdout.write(f"Conversation {conversation.id}: archived {count} messages")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {archived} messages from {conversations} conversations (sent before {cutoff:%Y-%m-%d})"
+        ))
+
+    def _finish_interrupted_run(self, conversation):
+        """A run that stopped between writing a segment and deleting its rows left them in both places"""
+        index = archive.read_index(conversation.id)
+        if index and Message.objects.filter(pk=index[-1]['last_id']).exists():
+            ids = [message.pk for message in archive.segment_messages(conversation.id, index[-1])]
+            Message.objects.filter(pk__in=ids).delete()
+
+    def _archive_conversation(self, conversation, cutoff, segment_size):
+        # The newest message stays live, the inbox preview points at it
+        candidates = (conversation.messages().filter(timestamp__lt=cutoff)
+                      .exclude(pk=conversation.last_message_id).order_by('timestamp', 'id'))
+        count = 0
+        while True:
+            # Archived rows are deleted, so the oldest remaining ones are always the next segment
+            batch = list(candidates[:segment_size])
+            if not batch:
+                return count
+            archive.write_segment(conversation.id, batch)
+            with transaction.atomic():
+                Message.objects.filter(pk__in=[message.pk for message in batch]).delete()
+            count += len(batch)
@@ -0,0 +1,39 @@
+# chatapp/management/commands/backfill_search_index.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chatapp.models import Message, MessageSearchToken
+from chatapp.search import build_tokens
+
+
+class Command(BaseCommand):
+    help = "Add messages saved before search existed (or all of them with --rebuild) to the search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Messages decrypted and indexed per batch")
+        parser.add_argument('--after', type=int, default=0, metavar='ID',
+                            help="Resume after this message id (printed after every batch)")
+        parser.add_argument('--rebuild', action='store_true',
+                            help="Drop the whole index first, e.g. after changing MESSAGE_SEARCH_KEY")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            deleted, _ = MessageSearchToken.objects.all().delete()
+            self.stdout.write(f"Dropped {deleted} index entries")
+
+        conversation_ids = {}  # (low, high) -> id, shared across batches
+        last_id, indexed = options['after'], 0
+        while True:
+            # Keyset walk over the primary key, every batch is one range scan
+            batch = list(Message.objects.filter(pk__gt=last_id).order_by('pk')[:options['batch_size']])
+            if not batch:
+                break
+            Message.decrypt_many(batch)
+            with transaction.atomic():
+                MessageSearchToken.objects.bulk_create(
+                    build_tokens(batch, conversation_ids), batch_size=5000, ignore_conflicts=True
+                )
+            last_id = batch[-1].pk
+            indexed += len(batch)
+            self.stdout.write(f"Indexed {indexed} messages (up to id {last_id})")
+
+        self.stdout.write(self.style.SUCCESS(f"Search index backfilled, {indexed} messages processed"))
@@ -0,0 +1,111 @@
+# chatapp/management/commands/benchmark_chat.py
+import asyncio
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from chatapp.benchmarks.harness import Scenario, compare_to_baseline, run_scenario
+
+
+class Command(BaseCommand):
+    help = ("Load-test ChatConsumer in-process on a throwaway test database and report "
+            "delivery latency, throughput and query counts")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, nargs='+', default=[10, 50],
+                            help="Concurrent users, one scenario per value")
+        parser.add_argument('--messages', type=int, default=10, help="Messages sent by every user")
+        parser.add_argument('--waves', type=int, default=5, help="Connect/disconnect waves")
+        parser.add_argument('--typing', type=int, default=3, help="Typing frames before every message")
+        parser.add_argument('--redis', metavar='URL',
+                            help="Use a Redis channel layer, cache and presence store at URL instead of in-memory ones")
+        parser.add_argument('--output', metavar='PATH', help="Write the results as JSON")
+        parser.add_argument('--baseline', metavar='PATH',
+                            help="Compare against saved results and fail on regressions")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Allowed latency/throughput drift against the baseline (fraction)")
+
+    def handle(self, *args, **options):
+        scenarios = [
+            Scenario(name=f"{users}_users", users=users, messages=options['messages'],
+                     waves=options['waves'], typing=options['typing'])
+            for users in options['users']
+        ]
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = json.loads(Path(options['baseline']).read_text())
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read baseline {options['baseline']}: {e}")
+
+        # The consumer logs every connect, keep the report readable
+        logging.getLogger('chatapp').setLevel(logging.WARNING)
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(**self.backend_settings(options['redis'])):
+                runs = [asyncio.run(run_scenario(scenario)) for scenario in scenarios]
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = {
+            'created': datetime.now().isoformat(),
+            'channel_layer': 'redis' if options['redis'] else 'memory',
+            'runs': runs,
+        }
+        for run in runs:
+            self.report(run)
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2))
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is not None:
+            regressions = compare_to_baseline(results, baseline, options['tolerance'])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(self.style.ERROR(regression))
+                raise CommandError(f"{len(regressions)} regression(s) against {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
+
+    def backend_settings(self, redis_url):
+        if redis_url:
+            return {
+                'CHANNEL_LAYERS': {'default': {
+                    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                    'CONFIG': {'hosts': [redis_url]},
+                }},
+                'CACHES': {'default': {
+                    'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                    'LOCATION': redis_url,
+                }},
+                'PRESENCE_BACKEND': 'redis',
+                'PRESENCE_REDIS_URL': redis_url,
+            }
+        return {
+            'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+            'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            'PRESENCE_BACKEND': 'local',
+        }
+
+    def report(self, run):
+        latency = run['latency_ms']
+        queries = run['queries']
+        fmt = lambda value: '-' if value is None else f"{value:.2f}"
+        self.stdout.write(self.style.MIGRATE_HEADING(run['scenario']['name']))
+        self.stdout.write(
+            f"  delivered {run['delivered']}/{run['expected']}  "
+            f"throughput {fmt(run['throughput_msgs_per_s'])} msg/s  "
+            f"connect {fmt(run['connect_ms_per_user'])} ms/user"
+        )
+        self.stdout.write(
+            f"  latency ms  p50 {fmt(latency['p50'])}  p95 {fmt(latency['p95'])}  "
+            f"p99 {fmt(latency['p99'])}"
+        )
+        self.stdout.write(
+            f"  queries  connect {queries['connect']}  chat {queries['chat']} "
+            f"({fmt(queries['per_message'])}/msg)  disconnect {queries['disconnect']}"
+        )
@@ -0,0 +1,69 @@
+# chatapp/management/commands/benchmark_fanout.py
+import asyncio
+import copy
+import json
+from datetime import datetime
+from pathlib import Path
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from redis.exceptions import ConnectionError as RedisConnectionError
+from chatapp.benchmarks.fanout import FanoutScenario, run_backend
+
+
+class Command(BaseCommand):
+    help = ("Compare channel-layer backends on group fan-out (1:1 chats up to lobby-sized groups) "
+            "and report delivery rate and latency")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', nargs='+', default=['memory'], choices=sorted(settings.CHANNEL_LAYER_BACKENDS),
+                            help="Backends from settings.CHANNEL_LAYER_BACKENDS to compare")
+        parser.add_argument('--hosts', nargs='+', metavar='URL',
+                            help="Redis URLs for the redis backends (several shard the core layer)")
+        parser.add_argument('--group-sizes', type=int, nargs='+', default=[2, 500],
+                            help="Channels per group, one scenario per value")
+        parser.add_argument('--messages', type=int, default=100, help="Group sends per scenario")
+        parser.add_argument('--payload', type=int, default=200, help="Bytes of text in every message")
+        parser.add_argument('--capacity', type=int, help="Override the per-channel capacity of the core layer")
+        parser.add_argument('--output', metavar='PATH', help="Write the results as JSON")
+
+    def handle(self, *args, **options):
+        scenarios = [
+            FanoutScenario(name=f"group_{size}", group_size=size, messages=options['messages'],
+                           payload_bytes=options['payload'])
+            for size in options['group_sizes']
+        ]
+        results = {'created': datetime.now().isoformat(), 'backends': {}}
+        for name in options['backend']:
+            config = self.backend_config(name, options)
+            try:
+                runs = asyncio.run(run_backend(config, scenarios))
+            except (OSError, RedisConnectionError) as e:
+                raise CommandError(f"Backend {name} is unreachable: {e}")
+            results['backends'][name] = {'config': config, 'runs': runs}
+            for run in runs:
+                self.report(name, run)
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(results, indent=2, default=str))
+            self.stdout.write(f"Results written to {options['output']}")
+
+    def backend_config(self, name, options):
+        config = copy.deepcopy(settings.CHANNEL_LAYER_BACKENDS[name])
+        layer_config = config.setdefault('CONFIG', {})
+        if options['hosts'] and 'hosts' in layer_config:
+            layer_config['hosts'] = options['hosts']
+        if options['capacity'] and 'capacity' in layer_config:
+            layer_config['capacity'] = options['capacity']
+        return config
+
+    def report(self, backend, run):
+        latency = run['latency_ms']
+        fmt = lambda value: '-' if value is None else f"{value:.2f}"
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{backend} {run['scenario']['name']}"))
+        self.stdout.write(
+            f"  delivered {run['delivered']}/{run['expected']}  "
+            f"sends {fmt(run['sends_per_s'])}/s  deliveries {fmt(run['deliveries_per_s'])}/s"
+        )
+        self.stdout.write(
+            f"  latency ms  p50 {fmt(latency['p50'])}  p95 {fmt(latency['p95'])}  p99 {fmt(latency['p99'])}"
+        )
@@ -0,0 +1,37 @@
+# chatapp/management/commands/export_messages.py
+import sys
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from chatapp.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, iter_export
+
+
+class Command(BaseCommand):
+    help = "Stream a user's messages (or one conversation) to a JSONL or CSV file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--with', dest='other', metavar='USERNAME', help="Only the conversation with this user")
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='jsonl')
+        parser.add_argument('--output', '-o', help="File to write (default: stdout)")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help="Messages fetched and decrypted at a time")
+
+    def _user(self, username):
+        try:
+            return User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(f"User {username} doesn't exist")
+
+    def handle(self, *args, **options):
+        user = self._user(options['username'])
+        other_user = self._user(options['other']) if options['other'] else None
+
+        out = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        try:
+            for block in iter_export(user, other_user, options['format'], options['chunk_size']):
+                out.write(block)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        if options['output']:
+            self.stderr.write(self.style.SUCCESS(f"Exported to {options['output']}"))
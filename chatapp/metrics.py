@@ -0,0 +1,179 @@
+# chatapp/metrics.py
+"""
+Minimal in-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms live in a per-process registry and are
+served by the /metrics view. Each worker process reports its own numbers, so
+scrape every worker (or run one per host).
+"""
+import functools
+import threading
+import time
+from bisect import bisect_left
+from .groups import PRESENCE_GROUP
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Context manager observing the wall time of its block"""
+        return _Timer(self, labels)
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+WS_CONNECTIONS = Gauge('zeenchat_ws_connections', 'Open WebSocket connections')
+WS_HANDLER_SECONDS = Histogram('zeenchat_ws_handler_seconds', 'Time spent in ChatConsumer receive handlers',
+                               ['handler'])
+GROUP_SEND_SECONDS = Histogram('zeenchat_group_send_seconds', 'Channel layer group_send latency',
+                               ['group_type'])
+DB_HOP_SECONDS = Histogram('zeenchat_db_hop_seconds',
+                           'Time awaiting database_sync_to_async calls, thread-pool queueing included',
+                           ['function'])
+VIEW_SECONDS = Histogram('zeenchat_view_seconds', 'Time spent in HTTP views', ['view'])
+WS_OUTBOUND_DROPPED = Counter('zeenchat_ws_outbound_dropped_total',
+                              'Outbound WebSocket events merged into a newer one or dropped under backpressure',
+                              ['event_type', 'reason'])
+WS_SLOW_CLIENT_DISCONNECTS = Counter('zeenchat_ws_slow_client_disconnects_total',
+                                     'WebSocket clients closed because their outbound queue overflowed',
+                                     ['reason'])
+WRITE_BEHIND_DROPPED = Counter('zeenchat_write_behind_dropped_total',
+                               'Buffered chat messages dropped because the database stayed unreachable')
+
+
+def group_type(group_name):
+    """Coarse label for a channel layer group name"""
+    if group_name == PRESENCE_GROUP:
+        return 'lobby'
+    if group_name.startswith('user_'):
+        return 'user'
+    if group_name.startswith('conversation_'):
+        return 'conversation'
+    return 'other'
+
+
+async def group_send(channel_layer, group_name, message):
+    """channel_layer.group_send, timed per group type (count is the histogram _count)"""
+    with GROUP_SEND_SECONDS.time(group_type=group_type(group_name)):
+        await channel_layer.group_send(group_name, message)
+
+
+def timed_view(view):
+    """Record the wall time of a Django view"""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with VIEW_SECONDS.time(view=view.__name__):
+            return view(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0004_friendrequest'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'timestamp', 'id'], name='chatapp_mes_sender__7f0d36_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_unread_counters(apps, schema_editor):
+    """One last GROUP BY over existing unread messages, counters are incremental from here on"""
+    Message = apps.get_model('chatapp', 'Message')
+    UnreadCounter = apps.get_model('chatapp', 'UnreadCounter')
+    rows = (Message.objects.filter(is_read=False)
+            .values('receiver_id', 'sender_id')
+            .annotate(count=models.Count('id')))
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(receiver_id=row['receiver_id'], sender_id=row['sender_id'], count=row['count']) for row in rows],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0006_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('receiver', 'sender'), name='unique_unread_counter')],
+            },
+        ),
+        migrations.RunPython(seed_unread_counters, migrations.RunPython.noop),
+    ]
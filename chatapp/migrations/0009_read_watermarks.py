@@ -0,0 +1,47 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:54
+
+from django.db import migrations, models
+
+
+def seed_read_watermarks(apps, schema_editor):
+    """Turn per-row is_read flags into one watermark per (receiver, sender): just before the oldest unread message"""
+    Message = apps.get_model('chatapp', 'Message')
+    UnreadCounter = apps.get_model('chatapp', 'UnreadCounter')
+    rows = (Message.objects.order_by().exclude(sender=models.F('receiver'))
+            .values('receiver_id', 'sender_id')
+            .annotate(newest=models.Max('id'), oldest_unread=models.Min('id', filter=models.Q(is_read=False))))
+    watermarks = {
+        (row['receiver_id'], row['sender_id']):
+            row['newest'] if row['oldest_unread'] is None else row['oldest_unread'] - 1
+        for row in rows
+    }
+
+    counters = list(UnreadCounter.objects.all())
+    for counter in counters:
+        counter.last_read_id = watermarks.pop((counter.receiver_id, counter.sender_id), 0)
+    UnreadCounter.objects.bulk_update(counters, ['last_read_id'], batch_size=1000)
+    UnreadCounter.objects.bulk_create(
+        [UnreadCounter(receiver_id=receiver_id, sender_id=sender_id, count=0, last_read_id=last_read_id)
+         for (receiver_id, sender_id), last_read_id in watermarks.items()],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0008_message_client_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='unreadcounter',
+            name='last_read_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(seed_read_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,124 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Greatest, Least
+
+
+BATCH_SIZE = 1000
+
+
+def _chunks(iterator, size=BATCH_SIZE):
+    chunk = []
+    for item in iterator:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed_conversations(apps, schema_editor):
+    """One Conversation per pair of users that exchanged messages, unread state copied from UnreadCounter"""
+    Message = apps.get_model('chatapp', 'Message')
+    UnreadCounter = apps.get_model('chatapp', 'UnreadCounter')
+    Conversation = apps.get_model('chatapp', 'Conversation')
+
+    rows = (Message.objects.order_by()
+            .annotate(low=Least('sender_id', 'receiver_id'), high=Greatest('sender_id', 'receiver_id'))
+            .values('low', 'high')
+            .annotate(last_message_id=models.Max('id'), last_activity=models.Max('timestamp')))
+    for chunk in _chunks(rows.iterator(chunk_size=BATCH_SIZE)):
+        Conversation.objects.bulk_create([
+            Conversation(user_low_id=row['low'], user_high_id=row['high'],
+                         last_message_id=row['last_message_id'], last_activity=row['last_activity'])
+            for row in chunk
+        ])
+
+    for counters in _chunks(UnreadCounter.objects.order_by('id').iterator(chunk_size=BATCH_SIZE)):
+        pairs = {tuple(sorted((counter.receiver_id, counter.sender_id))) for counter in counters}
+        conversations = {
+            (conversation.user_low_id, conversation.user_high_id): conversation
+            for conversation in Conversation.objects.filter(user_low_id__in={low for low, _ in pairs},
+                                                            user_high_id__in={high for _, high in pairs})
+            if (conversation.user_low_id, conversation.user_high_id) in pairs
+        }
+        created = {}
+        for counter in counters:
+            low, high = sorted((counter.receiver_id, counter.sender_id))
+            conversation = conversations.get((low, high))
+            if conversation is None:
+                # Read state without messages (watermark rows from 0009)
+                conversation = conversations[(low, high)] = created[(low, high)] = Conversation(
+                    user_low_id=low, user_high_id=high
+                )
+            side = 'low' if counter.receiver_id == low else 'high'
+            setattr(conversation, f'{side}_unread', counter.count)
+            setattr(conversation, f'{side}_last_read_id', counter.last_read_id)
+        Conversation.objects.bulk_create(created.values())
+        Conversation.objects.bulk_update(
+            [conversation for pair, conversation in conversations.items() if pair not in created],
+            ['low_unread', 'high_unread', 'low_last_read_id', 'high_last_read_id']
+        )
+
+
+def unseed_conversations(apps, schema_editor):
+    """Rebuild UnreadCounter rows from the conversations (the Conversation table is dropped right after)"""
+    UnreadCounter = apps.get_model('chatapp', 'UnreadCounter')
+    Conversation = apps.get_model('chatapp', 'Conversation')
+    for chunk in _chunks(Conversation.objects.order_by('id').iterator(chunk_size=BATCH_SIZE)):
+        counters = []
+        for conversation in chunk:
+            sides = [('low', conversation.user_low_id, conversation.user_high_id)]
+            if conversation.user_high_id != conversation.user_low_id:
+                sides.append(('high', conversation.user_high_id, conversation.user_low_id))
+            for side, receiver_id, sender_id in sides:
+                count = getattr(conversation, f'{side}_unread')
+                last_read_id = getattr(conversation, f'{side}_last_read_id')
+                if count or last_read_id:
+                    counters.append(UnreadCounter(receiver_id=receiver_id, sender_id=sender_id,
+                                                  count=count, last_read_id=last_read_id))
+        UnreadCounter.objects.bulk_create(counters)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0009_read_watermarks'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity', models.DateTimeField(blank=True, null=True)),
+                ('low_unread', models.PositiveIntegerField(default=0)),
+                ('high_unread', models.PositiveIntegerField(default=0)),
+                ('low_last_read_id', models.BigIntegerField(default=0)),
+                ('high_last_read_id', models.BigIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chatapp.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_low', '-last_activity'], name='chatapp_con_user_lo_a4b02e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_high', '-last_activity'], name='chatapp_con_user_hi_22117b_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_conversation'),
+        ),
+        migrations.RunPython(seed_conversations, unseed_conversations),
+        migrations.DeleteModel(
+            name='UnreadCounter',
+        ),
+    ]
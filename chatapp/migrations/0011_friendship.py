@@ -0,0 +1,59 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_friendships(apps, schema_editor):
+    """Both directions of every accepted friend request"""
+    FriendRequest = apps.get_model('chatapp', 'FriendRequest')
+    Friendship = apps.get_model('chatapp', 'Friendship')
+    pairs = set()
+    for sender_id, receiver_id in FriendRequest.objects.filter(status='accepted').values_list('sender_id', 'receiver_id'):
+        pairs.update({(sender_id, receiver_id), (receiver_id, sender_id)})
+    Friendship.objects.bulk_create(
+        [Friendship(user_id=user_id, friend_id=friend_id) for user_id, friend_id in pairs if user_id != friend_id],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0010_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['sender', 'receiver'], name='chatapp_fri_sender__440769_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['receiver', 'status'], name='chatapp_fri_receive_ada2ce_idx'),
+        ),
+        migrations.AddField(
+            model_name='friendship',
+            name='friend',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='friendship',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='friendships', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='friendship',
+            constraint=models.UniqueConstraint(fields=('user', 'friend'), name='unique_friendship'),
+        ),
+        migrations.RunPython(seed_friendships, migrations.RunPython.noop),
+    ]
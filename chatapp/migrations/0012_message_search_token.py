@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0011_friendship'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.BinaryField(max_length=16)),
+                ('message_id', models.BigIntegerField()),
+                ('conversation', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chatapp.conversation')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'token', 'message_id'), name='unique_search_token')],
+            },
+        ),
+    ]
@@ -1,12 +1,10 @@
 # chatapp/models.py
-import base64
-from cryptography.fernet import Fernet
-from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-import hashlib
+from . import crypto
+from .crypto import get_cipher  # noqa: F401 (kept importable from here)
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -19,50 +17,130 @@ class UserProfile(models.Model):
             models.Index(fields=['last_seen'])
         ]
 
-def get_cipher():
-    # Create a proper 32-byte key from SECRET_KEY
-    key_material = settings.SECRET_KEY.encode()
-    # Use SHA256 to ensure we get exactly 32 bytes
-    key_bytes = hashlib.sha256(key_material).digest()
-    # Base64 encode to get the proper format for Fernet
-    key = base64.urlsafe_b64encode(key_bytes)
-    return Fernet(key)
-
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
     
     _content = models.TextField(db_column='content', default="")  # Store encrypted content
-    timestamp = models.DateTimeField(auto_now_add=True)
-    is_read = models.BooleanField(default=False)
+    timestamp = models.DateTimeField(default=timezone.now)  # set in Python so write-behind keeps send time
+    client_key = models.CharField(max_length=64, null=True, blank=True)  # Sender's idempotency key
 
     class Meta:
         ordering = ('timestamp',)
+        indexes = [
+            # Keyset pagination of a conversation, one direction at a time
+            models.Index(fields=['sender', 'receiver', 'timestamp', 'id']),
+        ]
+        constraints = [
+            # A client retrying a send with the same key must not store it twice
+            models.UniqueConstraint(fields=['sender', 'client_key'], condition=models.Q(client_key__isnull=False),
+                                    name='unique_message_client_key'),
+        ]
 
     def __str__(self):
         return f'{self.sender} to {self.receiver}'
 
     @property
     def content(self):
-        """Decrypt message before serving."""
-        if not self._content:
-            return ""
-        try:
-            cipher = get_cipher()
-            return cipher.decrypt(self._content.encode()).decode()
-        except Exception:
-            # If decryption fails, return the original content
-            # This helps with any existing unencrypted data
-            return self._content
+        """Decrypt message before serving (once per instance)."""
+        if '_plaintext' not in self.__dict__:
+            self._plaintext = crypto.decrypt(self._content)
+        return self._plaintext
 
     @content.setter
     def content(self, raw_text):
         """Encrypt message before saving."""
-        if not raw_text:
-            self._content = ""
-            return
-        cipher = get_cipher()
-        self._content = cipher.encrypt(raw_text.encode()).decode()
+        self._content = crypto.encrypt(raw_text) if raw_text else ""
+        self._plaintext = raw_text or ""
+
+    @classmethod
+    def decrypt_many(cls, messages):
+        """Decrypt a whole page of messages in one batch so .content is free afterwards"""
+        pending = [message for message in messages if '_plaintext' not in message.__dict__]
+        for message, plaintext in zip(pending, crypto.decrypt_many([m._content for m in pending])):
+            message._plaintext = plaintext
+        return messages
+
+class Conversation(models.Model):
+    """
+    The chat between two users, with its inbox metadata kept up to date on every message.
+
+    Participants are stored in id order (user_low.id <= user_high.id) so each
+    pair has exactly one row. Per-participant fields are prefixed low_/high_:
+    the read watermark (last Message id read) and how many messages arrived
+    after it.
+    """
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_activity = models.DateTimeField(null=True, blank=True)
+    low_unread = models.PositiveIntegerField(default=0)
+    high_unread = models.PositiveIntegerField(default=0)
+    low_last_read_id = models.BigIntegerField(default=0)
+    high_last_read_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_conversation'),
+        ]
+        indexes = [
+            # A user's inbox, newest first, from either side of the pair
+            models.Index(fields=['user_low', '-last_activity']),
+            models.Index(fields=['user_high', '-last_activity']),
+        ]
+
+    def __str__(self):
+        return f'{self.user_low} and {self.user_high}'
+
+    @staticmethod
+    def pair(user_id, other_id):
+        """Lookup kwargs for the conversation between two users"""
+        low, high = sorted((user_id, other_id))
+        return {'user_low_id': low, 'user_high_id': high}
+
+    @staticmethod
+    def side(user_id, other_id):
+        """Prefix ('low' or 'high') of user_id's fields in their conversation with other_id"""
+        return 'low' if user_id <= other_id else 'high'
+
+    @classmethod
+    def involving(cls, user):
+        return cls.objects.filter(models.Q(user_low=user) | models.Q(user_high=user))
+
+    def messages(self):
+        """Live messages of this conversation, both directions"""
+        low, high = self.user_low_id, self.user_high_id
+        return Message.objects.filter(
+            models.Q(sender_id=low, receiver_id=high) | models.Q(sender_id=high, receiver_id=low)
+        )
+
+    def other_user(self, user):
+        return self.user_high if self.user_low_id == user.id else self.user_low
+
+    def unread_for(self, user):
+        return self.low_unread if self.user_low_id == user.id else self.high_unread
+
+class MessageSearchToken(models.Model):
+    """
+    Blind search index: one row per distinct word of a message.
+
+    `token` is crypto.search_token(conversation, word), so no plaintext is
+    stored. message_id is a plain column rather than a foreign key, so
+    entries stay valid for messages moved out of the Message table.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='+', db_index=False)
+    token = models.BinaryField(max_length=16)
+    message_id = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            # Also the search index: equality on (conversation, token), newest message first
+            models.UniqueConstraint(fields=['conversation', 'token', 'message_id'], name='unique_search_token'),
+        ]
+
+    def __str__(self):
+        return f'#{self.message_id} in {self.conversation_id}'
+
 
 class FriendRequest(models.Model):
     class Status(models.TextChoices):
@@ -73,8 +151,29 @@ class FriendRequest(models.Model):
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_request')
     status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', 'receiver']),
+            models.Index(fields=['receiver', 'status']),  # a user's pending requests
+        ]
 
     def __str__(self):
         return f'{self.sender} to {self.receiver}'
 
+
+class Friendship(models.Model):
+    """One direction of an accepted friendship, both directions are stored"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friendships')
+    friend = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # Also the index behind "friends of user"
+            models.UniqueConstraint(fields=['user', 'friend'], name='unique_friendship'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} and {self.friend}'
+
     
\ No newline at end of file
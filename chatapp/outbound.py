@@ -0,0 +1,155 @@
+# chatapp/outbound.py
+"""
+Per-connection outbound queue with backpressure.
+
+ChatConsumer never awaits the socket from a handler: events go into an
+OutboundQueue and one writer task per connection sends them. A slow client
+therefore only delays itself, and the consumer keeps draining its channel
+layer inbox, so the layer's capacity never fills up and drops events at
+random.
+
+The queue is bounded and not every event is equally important:
+
+* State events (typing, presence deltas, counters, snapshots) only matter
+  in their latest version, so a newer one replaces a queued one with the
+  same key.
+* Low-priority events (typing, presence deltas, pongs) are dropped first.
+  Once the queue is past its high-water mark, new ones are not queued at
+  all. A client that misses presence deltas notices the sequence gap and
+  asks for a snapshot.
+* Everything else (chat messages, receipts, replays) is never dropped and is
+  sent before low-priority events. If the queue is full of it, the client
+  is disconnected. It reconnects and replays what it missed with `resume`.
+
+A client that stays above the high-water mark for longer than
+slow_timeout seconds is also disconnected.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from .metrics import WS_OUTBOUND_DROPPED
+
+LOW_PRIORITY = {'typing_indicator', 'presence_changed', 'pong'}
+
+# Events that carry a full state: a newer one replaces the queued one with the same key
+MERGE_KEYS = {
+    'typing_indicator': lambda event: ('typing', event['sender']),
+    'presence_changed': lambda event: ('presence', event['username']),
+    'presence_snapshot': lambda event: ('presence_snapshot',),
+    'unread_counts': lambda event: ('unread_counts',),
+    'pong': lambda event: ('pong',),
+}
+
+OVERFLOW_FULL = 'full'
+OVERFLOW_SLOW = 'slow'
+
+
+class OutboundQueue:
+    """
+    Bounded, prioritized queue of events for one connection.
+
+    `send_batch(events)` is awaited by the writer task with everything taken
+    from the queue at once (batch_window seconds after the first event, so
+    batching codecs get one frame). `on_overflow(reason)` is called once,
+    when the client has to be disconnected.
+    """
+
+    def __init__(self, send_batch, on_overflow, max_size=500, high_water=200, slow_timeout=10.0, batch_window=0):
+        self.send_batch = send_batch
+        self.on_overflow = on_overflow
+        self.max_size = max_size
+        self.high_water = high_water
+        self.slow_timeout = slow_timeout
+        self.batch_window = batch_window
+        self._high = deque()
+        self._low = OrderedDict()  # merge key (or a unique key) -> event, oldest first
+        self._merged = {}  # merge key -> index of the event in _high it may replace
+        self._ready = asyncio.Event()
+        self._over_since = None  # monotonic time the queue went above the high-water mark
+        self._sequence = 0
+        self.overflowed = False
+        self.writer = None
+
+    def __len__(self):
+        return len(self._high) + len(self._low)
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_forever())
+
+    async def stop(self):
+        if self.writer is not None:
+            self.writer.cancel()
+            await asyncio.gather(self.writer, return_exceptions=True)
+
+    def put(self, event):
+        """Queue an event without waiting, merging or dropping it as described above"""
+        if self.overflowed:
+            return
+        event_type = event.get('type')
+        merge_key = MERGE_KEYS[event_type](event) if event_type in MERGE_KEYS else None
+
+        if event_type in LOW_PRIORITY:
+            if merge_key in self._low:
+                self._low[merge_key] = event
+                WS_OUTBOUND_DROPPED.inc(event_type=event_type, reason='merged')
+            elif len(self) >= self.high_water:
+                WS_OUTBOUND_DROPPED.inc(event_type=event_type, reason='dropped')
+            else:
+                self._sequence += 1
+                self._low[merge_key or self._sequence] = event
+        else:
+            index = self._merged.get(merge_key)
+            if index is not None and index < len(self._high) and self._high[index].get('type') == event_type:
+                self._high[index] = event
+                WS_OUTBOUND_DROPPED.inc(event_type=event_type, reason='merged')
+            else:
+                while len(self) >= self.max_size and self._low:
+                    _, dropped = self._low.popitem(last=False)
+                    WS_OUTBOUND_DROPPED.inc(event_type=dropped.get('type'), reason='dropped')
+                if len(self) >= self.max_size:
+                    self._overflow(OVERFLOW_FULL)
+                    return
+                self._high.append(event)
+                if merge_key is not None:
+                    self._merged[merge_key] = len(self._high) - 1
+
+        self._check_high_water()
+        self._ready.set()
+
+    def _check_high_water(self):
+        if len(self) < self.high_water:
+            self._over_since = None
+            return
+        now = time.monotonic()
+        if self._over_since is None:
+            self._over_since = now
+        elif now - self._over_since > self.slow_timeout:
+            self._overflow(OVERFLOW_SLOW)
+
+    def _overflow(self, reason):
+        self.overflowed = True
+        self.on_overflow(reason)
+        for event in [*self._high, *self._low.values()]:
+            WS_OUTBOUND_DROPPED.inc(event_type=event.get('type'), reason='disconnected')
+        self._high.clear()
+        self._low.clear()
+        self._merged.clear()
+
+    def take(self):
+        """Everything queued, high priority first"""
+        events = [*self._high, *self._low.values()]
+        self._high.clear()
+        self._low.clear()
+        self._merged.clear()
+        self._ready.clear()
+        return events
+
+    async def _write_forever(self):
+        while True:
+            await self._ready.wait()
+            if self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            events = self.take()
+            if events:
+                await self.send_batch(events)
+            self._check_high_water()
@@ -0,0 +1,147 @@
+# chatapp/pagination.py
+"""
+Keyset (cursor) pagination for chat history.
+
+Pages are keyed on (timestamp, id) and always read "messages before X", so
+every page costs the same two short index range scans no matter how deep
+into a conversation the user has scrolled. There is no COUNT(*) and no
+OFFSET. Cursors are opaque to the client.
+
+Once the database runs out of older rows the page continues into the
+archive (see archive.py), which only holds messages older than everything
+still in the database.
+
+Reconnecting sockets use the other direction: get_messages_since replays
+everything after the last message id a client has seen. Ids only follow
+commit order with synchronous writes; with write-behind every worker hands
+out ids from its own reserved block, so the replay goes by timestamp instead
+and starts `overlap` before the last seen message (clients drop the
+duplicates by id).
+"""
+import base64
+from datetime import datetime
+from django.db import models
+from django.utils import timezone
+from . import archive
+from .conversations import find_conversation_id
+
+HISTORY_PAGE_SIZE = 10  # number kept low for testing, set to optimal number of messages
+RESUME_LIMIT = 200  # messages replayed to a reconnecting socket before it is told to reload
+
+
+def encode_cursor(message):
+    """Turn the oldest message of a page into an opaque 'before' cursor"""
+    raw = f"{message.timestamp.isoformat()}|{message.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor, raises ValueError on anything malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, pk = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid history cursor: {cursor!r}") from e
+
+
+class HistoryPage:
+    """One page of messages in chronological order plus the cursor to the page before it"""
+
+    def __init__(self, messages, previous_cursor=None):
+        self.messages = messages
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def _before(queryset, cursor):
+    """Restrict a queryset to rows strictly older than the (timestamp, id) cursor"""
+    if cursor is None:
+        return queryset
+    timestamp, pk = cursor
+    return queryset.filter(
+        models.Q(timestamp__lt=timestamp) |
+        models.Q(timestamp=timestamp, pk__lt=pk)
+    )
+
+
+def get_history_page(user, other_user, before=None, page_size=HISTORY_PAGE_SIZE):
+    """
+    Return the page of the conversation between two users ending just before `before`.
+
+    Each direction of the conversation is read separately so both queries are
+    a backwards range scan on the (sender, receiver, timestamp, id) index that
+    stops after page_size + 1 rows. The two short lists are merged here,
+    topped up from the archive when the database has no more.
+    """
+    from .models import Message
+    cursor = decode_cursor(before) if before else None
+
+    rows = []
+    for sender, receiver in ((user, other_user), (other_user, user)):
+        queryset = Message.objects.filter(sender=sender, receiver=receiver)
+        rows.extend(_before(queryset, cursor).order_by('-timestamp', '-id')[:page_size + 1])
+        if sender == receiver:
+            break  # Notes to self live in a single direction
+
+    conversation_id = find_conversation_id(user.id, other_user.id) if len(rows) <= page_size else None
+    if conversation_id is not None:
+        # Both directions ran out, older history is in the archive (if any)
+        live_ids = {message.pk for message in rows}
+        archived = archive.messages_before(
+            conversation_id, cursor, page_size + 1,
+            users={user.id: user, other_user.id: other_user}
+        )
+        rows.extend(message for message in archived if message.pk not in live_ids)
+
+    rows.sort(key=lambda message: (message.timestamp, message.pk), reverse=True)
+    has_more = len(rows) > page_size
+    page = rows[:page_size]
+    page.reverse()
+
+    previous_cursor = encode_cursor(page[0]) if has_more else None
+    return HistoryPage(Message.decrypt_many(page), previous_cursor)
+
+
+def get_messages_since(user, since_id, other_user_id=None, limit=RESUME_LIMIT, overlap=None):
+    """
+    Return (messages, complete): everything sent to or by `user` after message `since_id`.
+
+    One forward range scan on the primary key, oldest first, with usernames
+    joined in and contents decrypted in one batch. `complete` is False when
+    more than `limit` messages were missed; the client should reload instead.
+    Optionally restricted to the conversation with `other_user_id`.
+
+    With an `overlap` (timedelta) the scan is on (timestamp, id) from
+    `overlap` before message `since_id` instead, for ids that don't follow
+    commit order. Already seen messages come back too.
+    """
+    from .models import Message
+    conversation_id = find_conversation_id(user.id, other_user_id) if other_user_id is not None else None
+    if conversation_id is not None and 0 < since_id < archive.last_archived_id(conversation_id):
+        # What was missed has partly moved to the archive, which a reload pages through
+        return [], False
+    if other_user_id is None:
+        participants = models.Q(sender=user) | models.Q(receiver=user)
+    else:
+        participants = (models.Q(sender=user, receiver_id=other_user_id) |
+                        models.Q(sender_id=other_user_id, receiver=user))
+    messages = Message.objects.filter(participants).select_related('sender', 'receiver')
+    if overlap is not None and since_id:
+        # The last seen message may itself still be buffered on its worker
+        anchor = Message.objects.filter(pk=since_id).values_list('timestamp', flat=True).first() or timezone.now()
+        messages = messages.filter(timestamp__gte=anchor - overlap).order_by('timestamp', 'id')
+    else:
+        messages = messages.filter(pk__gt=since_id).order_by('id')
+    rows = list(messages[:limit + 1])
+    return Message.decrypt_many(rows[:limit]), len(rows) <= limit
@@ -0,0 +1,220 @@
+# chatapp/persistence.py
+"""
+Message persistence for the WebSocket path.
+
+settings.CHAT_MESSAGE_DURABILITY picks how a chat frame is stored:
+
+* "sync"    - one INSERT per message before it is broadcast (default)
+* "batched" - write-behind: the message gets its id from a block reserved
+              on the Postgres sequence, is broadcast straight away and is
+              buffered in this worker. The buffer is written with a single
+              bulk_create once it holds CHAT_WRITE_BEHIND_BATCH_SIZE
+              messages or CHAT_WRITE_BEHIND_FLUSH_INTERVAL seconds have
+              passed, and once more when the process exits.
+
+Either way a message can carry the client's idempotency key, so a send the
+client retries after a reconnect is stored once.
+
+A failed flush keeps its messages (they were already delivered) and retries
+with an exponential back-off capped at CHAT_WRITE_BEHIND_MAX_BACKOFF seconds.
+While the database stays down the buffer is capped at
+CHAT_WRITE_BEHIND_MAX_BUFFER messages; past that the oldest are dropped, logged
+and counted in zeenchat_write_behind_dropped_total.
+"""
+import asyncio
+import atexit
+import logging
+import time
+from collections import deque
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from .db import database_sync_to_async
+from .conversations import record_new_messages
+from .metrics import WRITE_BEHIND_DROPPED
+from .search import index_messages
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_SYNC = 'sync'
+DURABILITY_BATCHED = 'batched'
+
+
+class MessageWriter:
+    """Saves chat messages for one worker process, either right away or write-behind"""
+
+    def __init__(self, durability=None, batch_size=None, flush_interval=None, max_buffer=None, max_backoff=None):
+        self.durability = durability or settings.CHAT_MESSAGE_DURABILITY
+        self.batch_size = batch_size or settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL
+        self.max_buffer = max_buffer or settings.CHAT_WRITE_BEHIND_MAX_BUFFER
+        self.max_backoff = max_backoff or settings.CHAT_WRITE_BEHIND_MAX_BACKOFF
+        self._buffer = []
+        self._flushing = []  # The batch being written right now, still visible to find()
+        self._failures = 0  # Flushes failed in a row
+        self._retry_at = 0  # Monotonic time before which only the scheduled retry flushes
+        self._reserved_ids = deque()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+        if self.durability == DURABILITY_BATCHED and connection.vendor != 'postgresql':
+            logger.warning(f"Write-behind needs PostgreSQL sequences, got {connection.vendor}; "
+                           f"falling back to synchronous message writes")
+            self.durability = DURABILITY_SYNC
+        if self.durability not in (DURABILITY_SYNC, DURABILITY_BATCHED):
+            raise ValueError(f"Unknown CHAT_MESSAGE_DURABILITY {self.durability!r}")
+
+    @property
+    def batched(self):
+        return self.durability == DURABILITY_BATCHED
+
+    async def save(self, sender, receiver_id, content, client_key=None):
+        """
+        Persist a message, returns (message, created) with its final id and timestamp.
+
+        created is False when the sender already stored a message under
+        `client_key` (a resend); the stored message is returned instead.
+        Write-behind only checks this worker's buffer here, callers look the
+        key up in the database with find() first.
+        """
+        from .models import Message
+        if not self.batched:
+            return await database_sync_to_async(self._create)(sender, receiver_id, content, client_key)
+
+        message = Message(sender=sender, receiver_id=receiver_id, content=content,
+                          client_key=client_key, timestamp=timezone.now())
+        message.id = await self._next_id()
+        # Checked after the last await, so a concurrent send of the same key can't slip in
+        existing = client_key is not None and self._find_pending(sender.id, client_key)
+        if existing:
+            return existing, False
+        self._buffer.append(message)
+        self._drop_overflow()
+
+        if len(self._buffer) >= self.batch_size and time.monotonic() >= self._retry_at:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return message, True
+
+    async def find(self, sender_id, client_key):
+        """The message a sender stored under an idempotency key, buffered or saved, or None"""
+        from .models import Message
+        return self._find_pending(sender_id, client_key) or await database_sync_to_async(
+            Message.objects.filter(sender_id=sender_id, client_key=client_key).first
+        )()
+
+    def _find_pending(self, sender_id, client_key):
+        """A buffered or currently flushing message stored under an idempotency key, or None"""
+        for message in (*self._flushing, *self._buffer):
+            if message.sender_id == sender_id and message.client_key == client_key:
+                return message
+        return None
+
+    def _create(self, sender, receiver_id, content, client_key):
+        from .models import Message
+        try:
+            # The conversation update (post_save) commits together with the INSERT
+            with transaction.atomic():
+                return Message.objects.create(sender=sender, receiver_id=receiver_id,
+                                              content=content, client_key=client_key), True
+        except IntegrityError:
+            if client_key is None:
+                raise
+            # Lost the race against a concurrent retry of the same send
+            return Message.objects.get(sender=sender, client_key=client_key), False
+
+    async def flush(self):
+        """Write everything buffered so far with a single bulk_create"""
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            self._flushing = batch
+            try:
+                await database_sync_to_async(self._write)(batch)
+            except Exception as e:
+                # Keep the messages (they were already delivered) and retry later, backing off
+                self._buffer[:0] = batch
+                self._failures += 1
+                delay = min(self.flush_interval * 2 ** self._failures, self.max_backoff)
+                self._retry_at = time.monotonic() + delay
+                logger.error(f"Failed to flush {len(batch)} buffered messages, retrying in {delay:.1f}s: {str(e)}")
+                self._drop_overflow()
+                if self._flush_task is None:
+                    self._flush_task = asyncio.create_task(self._flush_later())
+            else:
+                self._failures = 0
+                self._retry_at = 0
+            finally:
+                self._flushing = []
+
+    def _drop_overflow(self):
+        """Drop the oldest buffered messages past max_buffer, they can't all wait for the database"""
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            WRITE_BEHIND_DROPPED.inc(overflow)
+            logger.error(f"Dropped {overflow} buffered messages, the write-behind buffer is full")
+
+    def flush_sync(self):
+        """Flush from synchronous code once the event loop is gone (process exit)"""
+        batch, self._buffer = self._buffer, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        from .models import Message
+        with transaction.atomic():
+            # Retries are looked up before buffering, a duplicate key must still not wedge the batch
+            Message.objects.bulk_create(batch, ignore_conflicts=True)
+            # Ids were reserved up front, so a skipped duplicate is simply a missing id
+            inserted_ids = set(Message.objects.filter(id__in=[m.id for m in batch]).values_list('id', flat=True))
+            inserted = [message for message in batch if message.id in inserted_ids]
+            record_new_messages(inserted)
+            index_messages(inserted)
+        if len(inserted) < len(batch):
+            logger.info(f"Skipped {len(batch) - len(inserted)} buffered messages already stored under their client key")
+        logger.debug(f"Flushed {len(inserted)} buffered messages")
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        while (backoff := self._retry_at - time.monotonic()) > 0:
+            await asyncio.sleep(backoff)
+        self._flush_task = None
+        await self.flush()
+
+    async def _next_id(self):
+        if not self._reserved_ids:
+            self._reserved_ids.extend(await database_sync_to_async(self._reserve_ids)(self.batch_size))
+        return self._reserved_ids.popleft()
+
+    def _reserve_ids(self, count):
+        """Take a block of ids from the Message primary key sequence in one round trip"""
+        from .models import Message
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [Message._meta.db_table, count]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+_writer = None
+
+
+def get_message_writer():
+    """The MessageWriter for this worker process"""
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter()
+    return _writer
+
+
+@atexit.register
+def _flush_on_exit():
+    if _writer is not None and _writer.batched:
+        try:
+            _writer.flush_sync()
+        except Exception as e:
+            logger.error(f"Lost buffered messages on shutdown: {str(e)}")
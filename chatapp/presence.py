@@ -0,0 +1,78 @@
+# chatapp/presence.py
+"""
+Presence protocol helpers.
+
+Clients get one full snapshot when they connect and afterwards only small
+`presence_changed` deltas. Every delta carries a global sequence number so a
+client can notice a gap (a missed or reordered delta) and ask for a fresh
+snapshot with a `presence_sync` frame.
+"""
+import logging
+from django.core.cache import cache
+from .db import database_sync_to_async
+from .groups import PRESENCE_GROUP
+from .metrics import group_send
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_SEQ_KEY = 'presence:seq'
+PRESENCE_SNAPSHOT_KEY = 'presence:snapshot'  # Versioned by the sequence number
+PRESENCE_SNAPSHOT_TIMEOUT = 300
+
+
+async def next_presence_seq():
+    """Reserve the next presence sequence number (shared by all workers)"""
+    await cache.aadd(PRESENCE_SEQ_KEY, 0, timeout=None)
+    try:
+        return await cache.aincr(PRESENCE_SEQ_KEY)
+    except ValueError:
+        # The key was evicted between add and incr, start over
+        await cache.aset(PRESENCE_SEQ_KEY, 1, timeout=None)
+        return 1
+
+
+async def current_presence_seq():
+    """Sequence number of the last delta that was handed out"""
+    return await cache.aget(PRESENCE_SEQ_KEY, 0)
+
+
+async def broadcast_presence_change(channel_layer, username, is_online):
+    """Tell every connected client that a single user went online/offline"""
+    seq = await next_presence_seq()
+    logger.debug(f"Presence delta #{seq}: {username} online={is_online}")
+    await group_send(channel_layer, PRESENCE_GROUP, {
+        'type': 'presence_changed',
+        'username': username,
+        'is_online': is_online,
+        'seq': seq
+    })
+    return seq
+
+
+@database_sync_to_async
+def load_user_list():
+    """Fetch every user and their online status with a single joined query"""
+    from django.contrib.auth.models import User
+    rows = (User.objects.exclude(is_superuser=True)
+            .order_by('username')
+            .values_list('username', 'userprofile__is_online'))
+    # Users without a profile come back as None from the LEFT JOIN
+    return [{'username': username, 'is_online': bool(is_online)} for username, is_online in rows]
+
+
+async def get_presence_snapshot():
+    """
+    Return (seq, users) for the current presence state.
+
+    The user list is built once per presence change and cached under the
+    sequence number it belongs to, so every socket that connects (or resyncs)
+    before the next change shares the same blob instead of querying again.
+    """
+    # Read the sequence first: deltas racing with the snapshot are re-applied, never lost
+    seq = await current_presence_seq()
+    users = await cache.aget(PRESENCE_SNAPSHOT_KEY, version=seq)
+    if users is None:
+        users = await load_user_list()
+        await cache.aset(PRESENCE_SNAPSHOT_KEY, users, timeout=PRESENCE_SNAPSHOT_TIMEOUT, version=seq)
+        logger.debug(f"Built presence snapshot #{seq} with {len(users)} users")
+    return seq, users
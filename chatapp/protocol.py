@@ -0,0 +1,78 @@
+# chatapp/protocol.py
+"""
+Wire formats for ChatConsumer.
+
+JSON text frames (one event per frame) stay the default and are what
+chat.js speaks. Clients can opt into msgpack binary frames by offering the
+"zeenchat.msgpack" WebSocket subprotocol or connecting with ?format=msgpack.
+In msgpack mode every outbound frame is an array of events: events queued
+for the same client within CHAT_BATCH_WINDOW seconds share one frame.
+Inbound msgpack frames carry a single event map. decode_frame() rejects
+frames of the wrong kind for the connection, undecodable ones and anything
+but a single event.
+"""
+import json
+from urllib.parse import parse_qs
+import msgpack
+
+SUBPROTOCOL_MSGPACK = 'zeenchat.msgpack'
+
+
+class ProtocolError(ValueError):
+    """An inbound frame that isn't one event in the connection's wire format"""
+
+
+class JsonCodec:
+    name = 'json'
+    binary = False
+    batched = False
+
+    def encode(self, events):
+        """One event per text frame"""
+        (event,) = events
+        return json.dumps(event)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+    batched = True
+
+    def encode(self, events):
+        """Any number of events in one binary frame"""
+        return msgpack.packb(list(events), use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec()
+
+
+def negotiate(scope):
+    """Pick the codec for a connection, returns (codec, subprotocol to accept with)"""
+    if SUBPROTOCOL_MSGPACK in scope.get('subprotocols', []):
+        return MSGPACK, SUBPROTOCOL_MSGPACK
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('format', [''])[0] == MSGPACK.name:
+        return MSGPACK, None
+    return JSON, None
+
+
+def decode_frame(codec, text_data=None, bytes_data=None):
+    """Decode one inbound frame into an event dict, raises ProtocolError for anything else"""
+    data = bytes_data if codec.binary else text_data
+    if data is None:
+        kind = 'binary' if bytes_data is not None else 'text'
+        raise ProtocolError(f"{kind} frame on a {codec.name} connection")
+    try:
+        event = codec.decode(data)
+    except (ValueError, TypeError) as e:
+        raise ProtocolError(f"undecodable {codec.name} frame: {str(e)}") from e
+    if not isinstance(event, dict):
+        raise ProtocolError(f"expected an event object, got {type(event).__name__}")
+    return event
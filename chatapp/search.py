@@ -0,0 +1,112 @@
+# chatapp/search.py
+"""
+Search over encrypted message history.
+
+Message bodies are only stored encrypted, so search goes through a blind
+index instead: every distinct normalized word of a message is stored as an
+HMAC token (see crypto.search_token) in MessageSearchToken. Tokens are
+written when a message is saved; `manage.py backfill_search_index` fills in
+older messages.
+
+A query is tokenized the same way for each of the user's conversations.
+Messages containing every word come back newest first, keyed on message id
+("before" the last id of the previous page), so each page is a handful of
+index range scans no matter how much history there is.
+"""
+import re
+import unicodedata
+from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from . import crypto
+from .conversations import find_conversation_id, get_conversation_id
+
+SEARCH_PAGE_SIZE = 20
+MIN_WORD_LENGTH = 2
+MAX_WORD_LENGTH = 64
+MAX_WORDS_PER_MESSAGE = 200
+MAX_QUERY_WORDS = 8
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def normalize_words(text):
+    """Distinct searchable words of a text: NFKC, case-folded, split on non-word characters"""
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    words = dict.fromkeys(
+        word for word in _WORD_RE.findall(text) if MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH
+    )
+    return list(words)[:MAX_WORDS_PER_MESSAGE]
+
+
+def build_tokens(messages, conversation_ids=None):
+    """MessageSearchToken rows for saved messages, `conversation_ids` maps (low, high) pairs to ids"""
+    from .models import MessageSearchToken
+    conversation_ids = {} if conversation_ids is None else conversation_ids
+    rows = []
+    for message in messages:
+        pair = tuple(sorted((message.sender_id, message.receiver_id)))
+        if pair not in conversation_ids:
+            conversation_ids[pair] = get_conversation_id(*pair)
+        conversation_id = conversation_ids[pair]
+        rows.extend(
+            MessageSearchToken(conversation_id=conversation_id, message_id=message.id,
+                               token=crypto.search_token(conversation_id, word))
+            for word in normalize_words(message.content)
+        )
+    return rows
+
+
+def index_messages(messages):
+    """Add freshly saved messages to the search index (one INSERT for the batch)"""
+    from .models import MessageSearchToken
+    MessageSearchToken.objects.bulk_create(build_tokens(messages), ignore_conflicts=True)
+
+
+def search_messages(user, query, other_user_id=None, before=None, page_size=SEARCH_PAGE_SIZE):
+    """
+    Return (message_ids, next_before) for messages of `user` containing every word of `query`.
+
+    Restricted to the conversation with `other_user_id` if given. Pass
+    next_before back as `before` for the next (older) page; it is None on
+    the last page.
+    """
+    from .models import Conversation, MessageSearchToken
+    words = normalize_words(query)[:MAX_QUERY_WORDS]
+    if not words:
+        return [], None
+
+    if other_user_id is None:
+        conversation_ids = list(Conversation.involving(user).values_list('id', flat=True))
+    else:
+        conversation_id = find_conversation_id(user.id, other_user_id)
+        conversation_ids = [] if conversation_id is None else [conversation_id]
+    if not conversation_ids:
+        return [], None
+
+    matches = models.Q()
+    for conversation_id in conversation_ids:
+        matches |= models.Q(conversation_id=conversation_id,
+                            token__in=[crypto.search_token(conversation_id, word) for word in words])
+    entries = MessageSearchToken.objects.filter(matches)
+    if before is not None:
+        entries = entries.filter(message_id__lt=before)
+
+    if len(words) == 1:
+        # Straight off the (conversation, token, message_id) index, stops after one page
+        entries = entries.order_by('-message_id')
+    else:
+        # A message matches once per query word it contains, so all words means len(words) rows
+        entries = (entries.values('message_id')
+                   .annotate(matched=models.Count('id'))
+                   .filter(matched=len(words))
+                   .order_by('-message_id'))
+    message_ids = list(entries.values_list('message_id', flat=True)[:page_size + 1])
+    next_before = message_ids[page_size - 1] if len(message_ids) > page_size else None
+    return message_ids[:page_size], next_before
+
+
+@receiver(post_save, sender='chatapp.Message')
+def _index_new_message(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        index_messages([instance])
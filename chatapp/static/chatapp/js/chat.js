@@ -1,63 +1,158 @@
 // chat.js
-class ChatManager {
-    constructor(currentUser, otherUser) {
-        console.log(` setting up chat between ${currentUser} and ${otherUser}!`); 
-               this.currentUser = currentUser;
-        this.currentUser = currentUser;
-        this.otherUser = otherUser; 
-        this.socket = null;                  
-        this.messageInput = document.getElementById('chat-message-input');  // Input field for typing messages
-        this.messageForm = document.getElementById('chat-form');           // Form for submitting messages
-        this.messagesDiv = document.getElementById('chat-messages');       // Where messages appear
-        this.csrfToken = document.querySelector('[name=csrfmiddlewaretoken]')?.value || 'N/A';
-        this.typingTimeout = null;           // Timer for typing indicator
-        this.hasStartedChat = false;         // Track if we've started the chat session
-        
-        this.initializeWebSocket();
-        this.setupEventListeners();
+
+/**
+ * The one WebSocket of a page. Managers subscribe to topics ('presence',
+ * 'notifications', 'conversation:<username>') and register handlers per event
+ * type; both survive reconnects. The socket pings the server so it keeps
+ * counting as online.
+ */
+class ChatSocket {
+    constructor() {
+        this.socket = null;
+        this.topics = new Set();             // Re-subscribed after every reconnect
+        this.handlers = new Map();           // event type -> callbacks
+        this.openHandlers = [];              // Run after every (re)connect, once topics are restored
+        this.pingTimer = null;
+        this.connect();
     }
 
-    /**
-     * Sets up the ws connection to handle real-time chat updates.
-     */
-    initializeWebSocket() {
+    connect() {
         const wsSchema = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${wsSchema}//${window.location.host}/ws/chat/`; 
-        console.log('Chat: Attempting to connect to WebSocket at:', wsUrl);
-        
+        const wsUrl = `${wsSchema}//${window.location.host}/ws/chat/`;
+        console.log('Socket: Attempting to connect to WebSocket at:', wsUrl);
+
         this.socket = new WebSocket(wsUrl);
 
         this.socket.onopen = () => {
-            console.log('Chat WebSocket connection established');
+            console.log('WebSocket connection established');
+            if (this.topics.size) {
+                this.send({'type': 'subscribe', 'topics': [...this.topics]});
+            }
+            this.openHandlers.forEach(callback => callback());
         };
 
         this.socket.onmessage = (event) => {
             const data = JSON.parse(event.data);
-            switch (data.type) {
-                case 'init':
-                    console.log(`Connected as ${data.username}`);
-                    break;
-                case 'chat_message':
-                    this.appendMessage(data.message, data.sender === this.currentUser, data.timestamp);
-                    break;
-                case 'typing_indicator':
-                    this.handleTypingIndicator(data.sender, data.is_typing);
-                    break;
-                case 'user_list':
-                    break;
+            if (data.type === 'init') {
+                console.log(`Connected as ${data.username}`);
+                this.startPing(data.ping_interval);
             }
+            (this.handlers.get(data.type) || []).forEach(callback => callback(data));
         };
 
         this.socket.onclose = () => {
-            console.log('Oops, chat connection dropped. Reconnecting in 5...');
-            setTimeout(() => this.initializeWebSocket(), 5000);
+            console.log('Oops, connection dropped. Reconnecting in 5...');
+            clearInterval(this.pingTimer);
+            setTimeout(() => this.connect(), 5000);
         };
 
         this.socket.onerror = (error) => {
-            console.error('Uh-oh, chat WebSocket hit a snag:', error);
+            console.error('Uh-oh, WebSocket hit a snag:', error);
         };
     }
 
+    get isOpen() {
+        return this.socket?.readyState === WebSocket.OPEN;
+    }
+
+    /**
+     * Sends one frame, dropped (returns false) while disconnected.
+     * @param {object} data - The frame
+     */
+    send(data) {
+        if (!this.isOpen) return false;
+        this.socket.send(JSON.stringify(data));
+        return true;
+    }
+
+    on(type, callback) {
+        if (!this.handlers.has(type)) this.handlers.set(type, []);
+        this.handlers.get(type).push(callback);
+    }
+
+    onOpen(callback) {
+        this.openHandlers.push(callback);
+        if (this.isOpen) callback();
+    }
+
+    subscribe(...topics) {
+        const added = topics.filter(topic => !this.topics.has(topic));
+        added.forEach(topic => this.topics.add(topic));
+        if (added.length) this.send({'type': 'subscribe', 'topics': added});
+    }
+
+    unsubscribe(...topics) {
+        const removed = topics.filter(topic => this.topics.delete(topic));
+        if (removed.length) this.send({'type': 'unsubscribe', 'topics': removed});
+    }
+
+    /**
+     * Pings the server every `seconds` (announced in the init frame).
+     */
+    startPing(seconds) {
+        clearInterval(this.pingTimer);
+        this.pingTimer = setInterval(() => this.send({'type': 'ping'}), (seconds || 20) * 1000);
+    }
+}
+
+class ChatManager {
+    constructor(currentUser, otherUser, connection) {
+        console.log(` setting up chat between ${currentUser} and ${otherUser}!`); 
+               this.currentUser = currentUser;
+        this.currentUser = currentUser;
+        this.otherUser = otherUser; 
+        this.connection = connection;        // The page's shared ChatSocket
+        this.messageInput = document.getElementById('chat-message-input');  // Input field for typing messages
+        this.messageForm = document.getElementById('chat-form');           // Form for submitting messages
+        this.messagesDiv = document.getElementById('chat-messages');       // Where messages appear
+        this.csrfToken = document.querySelector('[name=csrfmiddlewaretoken]')?.value || 'N/A';
+        this.typingTimeout = null;           // Timer for typing indicator
+        this.lastTypingSent = 0;             // When we last told the server we're typing
+        this.seenMessageIds = new Set();     // Messages already on screen, replays may repeat them
+        this.lastMessageId = 0;              // Newest message we have, the resume point after a reconnect
+        this.outbox = new Map();             // client_key -> sent frame the server has not confirmed yet
+        this.lastReadSent = 0;               // Read watermark we last reported for otherUser's messages
+        this.newestPeerMessageId = 0;        // Newest message from otherUser in this chat, what we report as read
+        this.readTimeout = null;             // Coalesces read reports while messages stream in
+        this.peerLastReadId = Number(this.messagesDiv?.dataset.peerLastReadId || 0);  // How far otherUser has read ours
+
+        this.messagesDiv?.querySelectorAll('[data-message-id]').forEach(element => {
+            this.trackMessageId(Number(element.dataset.messageId));
+            if (!element.classList.contains('justify-end')) {
+                this.newestPeerMessageId = Math.max(this.newestPeerMessageId, Number(element.dataset.messageId));
+            }
+        });
+        this.renderSeenMarker();
+        this.listen();
+        this.setupEventListeners();
+    }
+
+    /**
+     * Subscribes to this conversation on the shared socket and handles its events.
+     */
+    listen() {
+        // Typing indicators of this chat flow once we are subscribed to it
+        this.connection.subscribe(`conversation:${this.otherUser}`);
+        this.connection.on('chat_message', data => this.receiveMessage(data));
+        this.connection.on('resume', data => {
+            if (!data.complete) {
+                // Missed too much to replay, the page render is cheaper
+                window.location.reload();
+                return;
+            }
+            data.messages.forEach(message => this.receiveMessage(message));
+        });
+        this.connection.on('typing_indicator', data => this.handleTypingIndicator(data.sender, data.is_typing));
+        this.connection.on('read_receipt', data => {
+            if (data.reader === this.otherUser && data.last_read_id > this.peerLastReadId) {
+                this.peerLastReadId = data.last_read_id;
+                this.renderSeenMarker();
+            }
+        });
+        // After every (re)connect, catch up on what we missed
+        this.connection.onOpen(() => this.resume());
+    }
+
     /**
      * Sets up listeners for form submission and typing events.
      */
@@ -67,61 +162,156 @@ class ChatManager {
                 e.preventDefault();
                 const message = this.messageInput?.value.trim();
                 if (!message) return;
-                if (this.socket.readyState === WebSocket.OPEN) {
-                    if (!this.hasStartedChat) {
-                        console.log('Chat: Starting private chat with:', this.otherUser);
-                        this.socket.send(JSON.stringify({
-                            'type': 'start_chat',
-                            'receiver': this.otherUser
-                        }));
-                        this.hasStartedChat = true;
-                    }
+                // Kept until the server echoes it back, resent with the same key after a reconnect
+                const frame = {
+                    'type': 'chat_message',
+                    'message': message,
+                    'sender': this.currentUser,
+                    'receiver': this.otherUser,
+                    'client_key': this.newClientKey()
+                };
+                this.outbox.set(frame.client_key, frame);
+                if (this.connection.send(frame)) {
                     console.log('Chat: Sending chat message:', message);
-                    this.socket.send(JSON.stringify({
-                        'type': 'chat_message',
-                        'message': message,
-                        'sender': this.currentUser,
-                        'receiver': this.otherUser
-                    }));
-                    this.messageInput.value = '';
                 }
+                this.messageInput.value = '';
             });
         }
 
         // Show typing indicator when user types
         if (this.messageInput) {
             this.messageInput.addEventListener('input', () => {
-                if (this.socket.readyState === WebSocket.OPEN) {
-                    console.log('Chat: Sending typing indicator');
-                    this.socket.send(JSON.stringify({
-                        'type': 'typing',
-                        'is_typing': true,
-                        'receiver': this.otherUser
-                    }));
+                if (this.connection.isOpen) {
+                    // The server only forwards changes and expires the state itself,
+                    // so one frame per second while typing is plenty
+                    const now = Date.now();
+                    if (now - this.lastTypingSent > 1000) {
+                        console.log('Chat: Sending typing indicator');
+                        this.connection.send({
+                            'type': 'typing',
+                            'is_typing': true,
+                            'receiver': this.otherUser
+                        });
+                        this.lastTypingSent = now;
+                    }
 
                     // Clear any existing timeout and set a new one to stop typing indicator
                     clearTimeout(this.typingTimeout);
                     this.typingTimeout = setTimeout(() => {
-                        this.socket.send(JSON.stringify({
+                        this.connection.send({
                             'type': 'typing',
                             'is_typing': false,
                             'receiver': this.otherUser
-                        }));
+                        });
+                        this.lastTypingSent = 0;
                     }, 1000);
                 }
             });
         }
     }
 
+    /**
+     * Asks for everything we missed while disconnected, then retries unconfirmed sends.
+     */
+    resume() {
+        if (!this.connection.isOpen) return;
+        this.connection.send({
+            'type': 'resume',
+            'since': this.lastMessageId,
+            'receiver': this.otherUser
+        });
+        this.outbox.forEach(frame => {
+            console.log('Chat: Retrying unconfirmed message:', frame.client_key);
+            this.connection.send({...frame, 'retry': true});
+        });
+    }
+
+    /**
+     * Handles a live or replayed message, showing each one only once.
+     * @param {object} data - chat_message event
+     */
+    receiveMessage(data) {
+        if (data.client_key) {
+            this.outbox.delete(data.client_key);
+        }
+        if (this.seenMessageIds.has(data.id)) return;
+        this.trackMessageId(data.id);
+        // Messages for every conversation arrive here, only show this one
+        if (this.isCurrentConversation(data.sender, data.receiver)) {
+            this.appendMessage(data.message, data.sender === this.currentUser, data.timestamp, data.id);
+            if (data.sender === this.otherUser) {
+                this.newestPeerMessageId = Math.max(this.newestPeerMessageId, data.id);
+                this.markRead();
+            }
+        }
+    }
+
+    /**
+     * Reports the newest message from otherUser as read, once per burst of messages.
+     */
+    markRead() {
+        clearTimeout(this.readTimeout);
+        this.readTimeout = setTimeout(() => {
+            // lastMessageId spans every conversation, the watermark is only about this one
+            if (this.newestPeerMessageId <= this.lastReadSent || !this.connection.isOpen) return;
+            this.connection.send({
+                'type': 'read',
+                'receiver': this.otherUser,
+                'last_read_id': this.newestPeerMessageId
+            });
+            this.lastReadSent = this.newestPeerMessageId;
+        }, 250);
+    }
+
+    /**
+     * Puts a "Seen" label under our newest message otherUser has read.
+     */
+    renderSeenMarker() {
+        if (!this.messagesDiv) return;
+        this.messagesDiv.querySelectorAll('.seen-marker').forEach(element => element.remove());
+        const ours = Array.from(this.messagesDiv.querySelectorAll('.justify-end[data-message-id]'))
+            .filter(element => Number(element.dataset.messageId) <= this.peerLastReadId);
+        const newest = ours[ours.length - 1];
+        if (newest) {
+            const marker = document.createElement('span');
+            marker.className = 'seen-marker block text-xs text-indigo-200';
+            marker.textContent = 'Seen';
+            newest.firstElementChild?.appendChild(marker);
+        }
+    }
+
+    trackMessageId(id) {
+        this.seenMessageIds.add(id);
+        this.lastMessageId = Math.max(this.lastMessageId, id);
+    }
+
+    newClientKey() {
+        if (window.crypto?.randomUUID) return window.crypto.randomUUID();
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    }
+
+    /**
+     * True if a message between these two users belongs to the open chat.
+     * @param {string} sender - Who sent it
+     * @param {string} receiver - Who it was sent to
+     * @returns {boolean}
+     */
+    isCurrentConversation(sender, receiver) {
+        return (sender === this.otherUser && receiver === this.currentUser) ||
+               (sender === this.currentUser && receiver === this.otherUser);
+    }
+
     /**
      * Adds a new message to the chat window.
      * @param {string} message - The text of the message
      * @param {boolean} isSender - True if the current user sent it
      * @param {string} timestamp - When the message was sent
+     * @param {number} id - Message id
      */
-    appendMessage(message, isSender, timestamp) {
+    appendMessage(message, isSender, timestamp, id) {
         console.log('Chat: Appending message:', message);
         const messageDiv = document.createElement('div');
+        messageDiv.dataset.messageId = id;
         messageDiv.className = `flex ${isSender ? 'justify-end' : ''}`; // Right for sender, left for receiver
         const time = timestamp ? new Date(timestamp).toLocaleTimeString([], { hour: 'numeric', minute: '2-digit' }) : new Date().toLocaleTimeString([], { hour: 'numeric', minute: '2-digit' });
         messageDiv.innerHTML = `
@@ -184,56 +374,52 @@ class ChatManager {
  * Keeps track of which users are online/offline & updates the UI.
  */
 class UserStatusManager {
-    constructor(currentUser) {
+    constructor(currentUser, connection) {
         this.currentUser = currentUser;
-        this.statusSocket = null;
+        this.connection = connection;        // The page's shared ChatSocket
         this.unreadCounts = {};
-        this.initializeStatusWebSocket();
-        this.fetchUnreadCounts();
+        this.presenceSeq = null;             // Last presence sequence number applied
+        this.listen();
     }
 
-    initializeStatusWebSocket() {
-        const wsSchema = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${wsSchema}//${window.location.host}/ws/chat/`;
-        console.log('Status: Attempting to connect to WebSocket at:', wsUrl);
-        
-        this.statusSocket = new WebSocket(wsUrl);
-
-        this.statusSocket.onopen = () => {
-            console.log('Status WebSocket connection established');
-        };
-
-        this.statusSocket.onmessage = (event) => {
-            const data = JSON.parse(event.data);
-            if (data.type === 'user_list') {
-                data.users.forEach(user => {
-                    this.updateUserStatus(user.username, user.is_online);
-                });
-            }else if (data.type === 'unread_message_update' && data.receiver === this.currentUser){
+    listen() {
+        this.connection.subscribe('presence', 'notifications');
+        this.connection.on('presence_snapshot', data => {
+            this.presenceSeq = data.seq;
+            data.users.forEach(user => {
+                this.updateUserStatus(user.username, user.is_online);
+            });
+        });
+        this.connection.on('presence_changed', data => this.handlePresenceChanged(data));
+        this.connection.on('unread_counts', data => {
+            this.unreadCounts = data.counts;
+            this.updateUnreadBadges();
+        });
+        this.connection.on('unread_message_update', data => {
+            if (data.receiver === this.currentUser) {
                 this.handleUnreadMessageUpdate(data.sender);
             }
-        };
-
-        this.statusSocket.onclose = () => {
-            console.log('Status WebSocket connection closed');
-            setTimeout(() => this.initializeStatusWebSocket(), 5000);
-        };
-
-        this.statusSocket.onerror = (error) => {
-            console.error('Status WebSocket error:', error);
-        };
+        });
     }
 
-    fetchUnreadCounts(){
-        fetch('/get-unread-counts/')
-            .then(response=>response.json())
-            .then(data => {
-                this.unreadCounts = data;
-                this.updateUnreadBadges();
-            })
-            .catch(error => {
-                console.error('Error fetching unread counts:', error);
+    /**
+     * Applies a single presence delta, asking for a new snapshot if we missed one.
+     * @param {object} data - {username, is_online, seq}
+     */
+    handlePresenceChanged(data) {
+        if (this.presenceSeq !== null && data.seq <= this.presenceSeq) {
+            return; // Already covered by the snapshot or an earlier delta
+        }
+        this.updateUserStatus(data.username, data.is_online);
+        const gap = this.presenceSeq === null || data.seq !== this.presenceSeq + 1;
+        this.presenceSeq = data.seq;
+        if (gap && this.connection.isOpen) {
+            console.log('Status: Presence gap detected, requesting a snapshot');
+            this.connection.send({
+                'type': 'presence_sync',
+                'seq': data.seq
             });
+        }
     }
 
     updateUnreadBadges(){
@@ -298,10 +484,13 @@ console.log('chat.js loaded');
 const currentUser = document.querySelector('meta[name="current-user"]')?.content;
 console.log(`Current user is: ${currentUser || 'nobody yet'}`);
 
+// One socket per page, shared by everything below
+const connection = currentUser ? new ChatSocket() : null;
+
 // Show online/offline status on the users list page
 if (currentUser) {
     console.log(`Starting status updates for ${currentUser}`);
-    new UserStatusManager(currentUser);
+    new UserStatusManager(currentUser, connection);
 } else {
     console.error('No current user found in meta tag');
 }
@@ -311,7 +500,7 @@ if (document.getElementById('chat-messages')) {
     const otherUser = document.querySelector('meta[name="other-user"]')?.content;
     console.log('Initializing ChatManager for:', currentUser, otherUser);
     if (currentUser && otherUser) {
-        new ChatManager(currentUser, otherUser);
+        new ChatManager(currentUser, otherUser, connection);
     } else {
         console.error('Missing currentUser or otherUser for ChatManager');
     }
@@ -1,3 +1,513 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import time
+from datetime import timedelta
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import archive, crypto, history_cache
+from .consumers import SLOW_CLIENT_CLOSE_CODE, ChatConsumer
+from .directory import user_directory
+from .export import aiter_export
+from .heartbeats import LocalHeartbeatStore, get_heartbeat_store, write_presence
+from .models import Conversation, Message, MessageSearchToken, UserProfile
+from .outbound import OVERFLOW_FULL, OVERFLOW_SLOW, OutboundQueue
+from .pagination import get_history_page, get_messages_since
+from .persistence import DURABILITY_BATCHED, MessageWriter
+from .routing import urlpatterns
+from .search import search_messages
+from .unread import get_unread_counts, mark_read
+
+
+@override_settings(MESSAGE_ENCRYPTION_KEYS=[('old', 'old secret')])
+class KeyringTests(SimpleTestCase):
+    """Key ids on ciphertexts and rotation of MESSAGE_ENCRYPTION_KEYS"""
+
+    def test_encrypt_tags_token_with_primary_key_id(self):
+        stored = crypto.encrypt('hello')
+        self.assertTrue(stored.startswith('old:'))
+        self.assertEqual(crypto.decrypt(stored), 'hello')
+
+    def test_rotation_keeps_old_messages_readable(self):
+        old = crypto.encrypt('before rotation')
+        bare = crypto.get_keyring()[1]['old'].encrypt(b'no key id').decode()
+        with override_settings(MESSAGE_ENCRYPTION_KEYS=[('new', 'new secret'), ('old', 'old secret')]):
+            new = crypto.encrypt('after rotation')
+            self.assertTrue(new.startswith('new:'))
+            self.assertEqual(crypto.decrypt(old), 'before rotation')
+            self.assertEqual(crypto.decrypt(bare), 'no key id')
+            with self.assertLogs('chatapp.crypto', 'WARNING'):  # The plain text fails every key
+                plaintexts = crypto.decrypt_many([new, old, '', bare, 'legacy plain text'])
+            self.assertEqual(plaintexts, ['after rotation', 'before rotation', '', 'no key id', 'legacy plain text'])
+
+    def test_retired_key_is_served_as_stored(self):
+        old = crypto.encrypt('secret')
+        with override_settings(MESSAGE_ENCRYPTION_KEYS=[('new', 'new secret')]), self.assertLogs('chatapp.crypto'):
+            self.assertEqual(crypto.decrypt(old), old)
+            self.assertEqual(crypto.decrypt_many([old]), [old])
+
+
+class OutboundQueueTests(SimpleTestCase):
+    """Merging, dropping and overflow of a connection's outbound events"""
+
+    async def make_queue(self, **options):
+        """A started queue whose writer is stuck sending its first event until self.unblock is set (stop it when done)"""
+        self.sent, self.overflows = [], []
+        self.unblock = asyncio.Event()
+
+        async def send_batch(events):
+            await self.unblock.wait()
+            self.sent.extend(events)
+
+        queue = OutboundQueue(send_batch, self.overflows.append, **options)
+        queue.start()
+        queue.put({'type': 'init'})
+        await asyncio.sleep(0)  # The writer takes init and blocks on it
+        return queue
+
+    async def test_state_events_merge_and_chat_goes_first(self):
+        queue = await self.make_queue(max_size=10, high_water=5)
+        for is_typing in (True, False, True):
+            queue.put({'type': 'typing_indicator', 'sender': 'bob', 'is_typing': is_typing})
+        queue.put({'type': 'unread_counts', 'counts': {'bob': 1}})
+        queue.put({'type': 'chat_message', 'id': 1})
+        queue.put({'type': 'unread_counts', 'counts': {'bob': 2}})
+        self.assertEqual(len(queue), 3)
+
+        self.unblock.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.sent, [
+            {'type': 'init'},
+            {'type': 'unread_counts', 'counts': {'bob': 2}},
+            {'type': 'chat_message', 'id': 1},
+            {'type': 'typing_indicator', 'sender': 'bob', 'is_typing': True},
+        ])
+        await queue.stop()
+
+    async def test_low_priority_events_are_dropped_past_high_water(self):
+        queue = await self.make_queue(max_size=10, high_water=3)
+        for i in range(3):
+            queue.put({'type': 'chat_message', 'id': i})
+        queue.put({'type': 'presence_changed', 'username': 'carol', 'is_online': True, 'seq': 1})
+        self.assertEqual(len(queue), 3)
+        await queue.stop()
+
+    async def test_full_queue_makes_room_then_overflows(self):
+        queue = await self.make_queue(max_size=3, high_water=3)
+        queue.put({'type': 'presence_changed', 'username': 'carol', 'is_online': True, 'seq': 1})
+        for i in range(3):
+            queue.put({'type': 'chat_message', 'id': i})  # The presence delta makes way for the third
+        self.assertEqual(self.overflows, [])
+        queue.put({'type': 'chat_message', 'id': 3})
+        self.assertEqual(self.overflows, [OVERFLOW_FULL])
+        self.assertEqual(len(queue), 0)
+        queue.put({'type': 'chat_message', 'id': 4})  # Ignored once overflowed
+        self.assertEqual((len(queue), self.overflows), (0, [OVERFLOW_FULL]))
+        await queue.stop()
+
+    async def test_staying_above_high_water_overflows(self):
+        queue = await self.make_queue(max_size=100, high_water=2, slow_timeout=0.05)
+        for i in range(3):
+            queue.put({'type': 'chat_message', 'id': i})
+        await asyncio.sleep(0.1)
+        queue.put({'type': 'chat_message', 'id': 3})
+        self.assertEqual(self.overflows, [OVERFLOW_SLOW])
+        await queue.stop()
+
+
+class HistoryPageTests(TestCase):
+    """Cursor paging through live rows and on into the archive"""
+
+    def setUp(self):
+        cache.clear()  # Conversation ids of earlier tests' users
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        archive_settings = override_settings(MESSAGE_ARCHIVE_DIR=archive_dir.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+    def send(self, count):
+        messages = []
+        for i in range(count):
+            sender, receiver = (self.alice, self.bob) if i % 2 == 0 else (self.bob, self.alice)
+            messages.append(Message.objects.create(sender=sender, receiver=receiver, content=f'message {i}'))
+        return messages
+
+    def read_all_pages(self, page_size):
+        pages, before = [], None
+        while True:
+            page = get_history_page(self.alice, self.bob, before=before, page_size=page_size)
+            pages.append([message.content for message in page])
+            if not page.has_previous:
+                return pages
+            before = page.previous_cursor
+
+    def test_pages_run_on_into_the_archive(self):
+        messages = self.send(7)
+        conversation = Conversation.objects.get()
+        archive.write_segment(conversation.id, messages[:4])
+        Message.objects.filter(id__in=[message.id for message in messages[:4]]).delete()
+
+        self.assertEqual(self.read_all_pages(page_size=3), [
+            ['message 4', 'message 5', 'message 6'],
+            ['message 1', 'message 2', 'message 3'],
+            ['message 0'],
+        ])
+        oldest = get_history_page(self.alice, self.bob, page_size=10).messages[0]
+        self.assertEqual((oldest.sender, oldest.receiver), (self.alice, self.bob))
+
+    def test_rows_still_live_are_not_repeated_from_the_archive(self):
+        messages = self.send(4)
+        # Interrupted archive run: segment written, rows not deleted yet
+        archive.write_segment(Conversation.objects.get().id, messages[:2])
+        self.assertEqual(self.read_all_pages(page_size=3), [['message 1', 'message 2', 'message 3'], ['message 0']])
+
+    def test_reading_a_chat_never_started_creates_no_conversation(self):
+        page = get_history_page(self.alice, self.bob)
+        self.assertEqual((list(page), page.has_previous), ([], False))
+        self.assertEqual(search_messages(self.alice, 'hello', other_user_id=self.bob.id), ([], None))
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('chat', kwargs={'username': 'bob'}), {'before': 'x'}, HTTP_HX_REQUEST='true')
+        self.assertEqual(response.content, b'')
+        self.assertFalse(Conversation.objects.exists())
+
+    def test_deleting_a_message_retires_cached_pages(self):
+        messages = self.send(2)
+        conversation_id = Conversation.objects.get().id
+        key = history_cache.page_key(conversation_id, self.bob.id, 'cursor')
+        history_cache.set_page(key, 'rendered')
+        messages[0].delete()
+        self.assertNotEqual(history_cache.page_key(conversation_id, self.bob.id, 'cursor'), key)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            get_history_page(self.alice, self.bob, before='not a cursor')
+
+
+class WriteBehindTests(TestCase):
+    """MessageWriter._write, the flush of a write-behind batch"""
+
+    def test_duplicate_client_key_is_neither_counted_nor_indexed(self):
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        stored = Message.objects.create(sender=alice, receiver=bob, content='first try', client_key='k1')
+        unread_before = Conversation.objects.get().unread_for(bob)
+
+        retry = Message(id=stored.id + 100, sender=alice, receiver=bob, content='first try', client_key='k1')
+        fresh = Message(id=stored.id + 101, sender=alice, receiver=bob, content='second', client_key='k2')
+        MessageWriter(durability='sync')._write([retry, fresh])
+
+        self.assertFalse(Message.objects.filter(id=retry.id).exists())
+        self.assertEqual(Conversation.objects.get().unread_for(bob), unread_before + 1)
+        self.assertEqual(set(MessageSearchToken.objects.values_list('message_id', flat=True)), {stored.id, fresh.id})
+
+    def batched_writer(self, **options):
+        """A write-behind writer on SQLite, ids handed out from 1000 instead of a Postgres sequence"""
+        writer = MessageWriter(durability='sync', **{'flush_interval': 60, **options})
+        writer.durability = DURABILITY_BATCHED
+        reserved = iter(range(1000, 2000))
+        writer._reserve_ids = lambda count: [next(reserved) for _ in range(count)]
+        return writer
+
+    async def test_resent_client_key_is_buffered_once(self):
+        alice = User(id=1, username='alice')
+        writer = self.batched_writer()
+        first, created = await writer.save(alice, 2, 'hello', client_key='k1')
+        again, created_again = await writer.save(alice, 2, 'hello', client_key='k1')
+        writer._flush_task.cancel()
+
+        self.assertEqual((created, created_again), (True, False))
+        self.assertIs(again, first)
+        self.assertEqual(writer._buffer, [first])
+
+    async def test_failed_flush_backs_off_and_caps_the_buffer(self):
+        writer = self.batched_writer(flush_interval=1, max_buffer=3)
+        writer._buffer = [Message(id=i, content=str(i)) for i in range(5)]
+
+        def database_down(batch):
+            raise OperationalError('connection refused')
+        writer._write = database_down
+        with self.assertLogs('chatapp.persistence', 'ERROR'):
+            await writer.flush()
+        writer._flush_task.cancel()
+
+        self.assertEqual([message.id for message in writer._buffer], [2, 3, 4])  # The oldest are dropped
+        self.assertGreater(writer._retry_at, time.monotonic() + 1)  # Backing off past flush_interval
+
+
+class ChatPageTests(TestCase):
+    """The chat page renders what chat.js needs to start a ChatManager"""
+
+    def test_page_names_both_users_for_chat_js(self):
+        alice = User.objects.create_user('alice')
+        User.objects.create_user('bob')
+        self.client.force_login(alice)
+        response = self.client.get(reverse('chat', kwargs={'username': 'bob'}))
+        self.assertContains(response, '<meta name="current-user" content="alice">', html=True)
+        self.assertContains(response, '<meta name="other-user" content="bob">', html=True)
+        self.assertContains(response, 'id="chat-messages"')
+        self.assertContains(response, 'chatapp/js/chat.js')
+
+
+class MetricsViewTests(TestCase):
+    """/metrics is closed unless a token is configured or a staff user asks"""
+
+    @override_settings(METRICS_TOKEN='')
+    def test_no_token_is_closed_except_for_staff(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        staff = User.objects.create_user('ops', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_token_is_required_when_set(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertContains(response, 'zeenchat_ws_connections')
+
+
+class PresenceTests(TestCase):
+
+    def test_profiles_are_created_alongside_stale_last_seen_refreshes(self):
+        regular = User.objects.create_user('regular')
+        newcomer = User.objects.create_user('newcomer')
+        UserProfile.objects.create(user=regular, is_online=True, last_seen=timezone.now() - timedelta(days=1))
+
+        came_online, went_offline = write_presence({regular.id, newcomer.id})
+        self.assertEqual((came_online, went_offline), (['newcomer'], []))
+        self.assertEqual(set(UserProfile.objects.filter(is_online=True).values_list('user__username', flat=True)),
+                         {'regular', 'newcomer'})
+
+    @override_settings(PRESENCE_BACKEND='local')
+    def test_logout_drops_every_heartbeat_of_the_user(self):
+        alice = User.objects.create_user('alice')
+        store = get_heartbeat_store()
+        for channel in ('tab-1', 'tab-2'):
+            async_to_sync(store.beat)(alice.id, channel, 60)
+        self.client.force_login(alice)
+        self.client.get(reverse('logout'))
+        self.assertEqual(async_to_sync(store.online_user_ids)(), set())
+
+    def test_store_follows_presence_backend_setting(self):
+        with override_settings(PRESENCE_BACKEND='local'):
+            self.assertIsInstance(get_heartbeat_store(), LocalHeartbeatStore)
+        with override_settings(PRESENCE_BACKEND='redis', PRESENCE_REDIS_URL='redis://localhost:1'):
+            self.assertNotIsInstance(get_heartbeat_store(), LocalHeartbeatStore)
+
+
+class ExportTests(TransactionTestCase):
+    """aiter_export, which runs the export on a thread with its own connection"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        for i in range(5):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f'message {i}')
+
+    async def test_streams_every_message_in_order(self):
+        body = b''.join([block async for block in aiter_export(self.alice, self.bob, chunk_size=2)])
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([row['content'] for row in rows], [f'message {i}' for i in range(5)])
+
+    async def test_client_leaving_early_stops_the_thread(self):
+        blocks = aiter_export(self.alice, self.bob, chunk_size=1)
+        self.assertIn(b'message 0', await anext(blocks))
+        await blocks.aclose()  # Returns only once the export thread is done
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    PRESENCE_BACKEND='local',
+    CHAT_MESSAGE_DURABILITY='sync',
+)
+class ChatSocketTestCase(TransactionTestCase):
+    """ChatConsumer tests over WebsocketCommunicator, without Redis"""
+
+    def setUp(self):
+        cache.clear()
+        user_directory._entries.clear()  # Ids of users from earlier tests
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.carol = User.objects.create_user('carol')
+
+    async def connect(self, user, subprotocols=None):
+        communicator = WebsocketCommunicator(URLRouter(urlpatterns), '/ws/chat/', subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await self.receive_events(communicator)  # init
+        return communicator
+
+    async def receive_events(self, communicator, timeout=0.2):
+        """Every event the client gets until the socket goes quiet (msgpack frames unpacked)"""
+        events = []
+        while not await communicator.receive_nothing(timeout=timeout):
+            frame = await communicator.receive_output()
+            if frame.get('bytes') is not None:
+                events.extend(msgpack.unpackb(frame['bytes']))
+            else:
+                events.append(json.loads(frame['text']))
+        return events
+
+    async def send_message(self, communicator, receiver, text, **extra):
+        await communicator.send_json_to({'type': 'chat_message', 'receiver': receiver, 'message': text, **extra})
+
+
+class ChatMessageTests(ChatSocketTestCase):
+
+    async def test_sender_is_the_authenticated_user(self):
+        bob = await self.connect(self.bob)
+        await bob.send_json_to({'type': 'subscribe', 'topics': ['notifications']})
+        await self.receive_events(bob)  # unread_counts
+        carol = await self.connect(self.carol)
+        await self.send_message(carol, 'bob', 'hi', sender='alice', client_key='k1')
+
+        received = await self.receive_events(bob)
+        self.assertEqual({event['type'] for event in received}, {'chat_message', 'unread_message_update'})
+        self.assertTrue(all(event['sender'] == 'carol' for event in received))
+
+        # A retry is only echoed to the sender, still under its real name
+        await self.send_message(carol, 'bob', 'hi', sender='alice', client_key='k1', retry=True)
+        echo = [event for event in await self.receive_events(carol) if event['type'] == 'chat_message']
+        self.assertEqual([event['sender'] for event in echo], ['carol', 'carol'])
+        await bob.disconnect()
+        await carol.disconnect()
+
+
+class ProtocolTests(ChatSocketTestCase):
+
+    async def test_bad_frames_are_dropped_not_fatal(self):
+        alice = await self.connect(self.alice, subprotocols=['zeenchat.msgpack'])
+        with self.assertLogs('chatapp.consumers', 'WARNING') as logs:
+            await alice.send_to(text_data='{"type": "ping"}')  # Text frame on a msgpack socket
+            await alice.send_to(bytes_data=b'\xc1')  # Not msgpack
+            await alice.send_to(bytes_data=msgpack.packb([1, 2]))  # Not an event
+            await alice.receive_nothing()
+        self.assertEqual(len(logs.records), 3)
+
+        await alice.send_to(bytes_data=msgpack.packb({'type': 'ping'}))
+        frame = msgpack.unpackb(await alice.receive_from())
+        self.assertEqual([event['type'] for event in frame], ['pong'])
+        await alice.disconnect()
+
+    async def test_malformed_json_is_dropped(self):
+        bob = await self.connect(self.bob)
+        with self.assertLogs('chatapp.consumers', 'WARNING'):
+            await bob.send_to(text_data='{not json')
+            await bob.send_to(text_data='"a string"')
+            await bob.receive_nothing()
+        await bob.send_json_to({'type': 'ping'})
+        self.assertEqual((await bob.receive_json_from())['type'], 'pong')
+        await bob.disconnect()
+
+
+class ResumeTests(ChatSocketTestCase):
+
+    async def test_retried_send_is_stored_once_and_replayed_once(self):
+        alice = await self.connect(self.alice)
+        await self.send_message(alice, 'bob', 'one', client_key='k1')
+        await self.send_message(alice, 'bob', 'one', client_key='k1', retry=True)
+        await self.send_message(alice, 'bob', 'one', client_key='k1')  # Retry without the flag hits the constraint
+        echoes = [event for event in await self.receive_events(alice) if event['type'] == 'chat_message']
+        self.assertEqual({event['id'] for event in echoes}, {echoes[0]['id']})
+        self.assertEqual(await Message.objects.filter(client_key='k1').acount(), 1)
+
+        bob = await self.connect(self.bob)
+        await bob.send_json_to({'type': 'resume', 'since': 0, 'receiver': 'alice'})
+        (resume,) = await self.receive_events(bob)
+        self.assertTrue(resume['complete'])
+        self.assertEqual([(m['id'], m['sender'], m['message']) for m in resume['messages']],
+                         [(echoes[0]['id'], 'alice', 'one')])
+
+        await bob.send_json_to({'type': 'resume', 'since': echoes[0]['id'], 'receiver': 'alice'})
+        (resume,) = await self.receive_events(bob)
+        self.assertEqual(resume['messages'], [])
+        await alice.disconnect()
+        await bob.disconnect()
+
+    def test_overlap_replays_lower_ids_stored_late(self):
+        seen = Message.objects.create(id=1000, sender=self.alice, receiver=self.bob, content='seen')
+        # Sent a moment later on another worker, with an id from a lower reserved block
+        late = Message.objects.create(id=900, sender=self.bob, receiver=self.alice,
+                                      content='late', timestamp=seen.timestamp + timedelta(milliseconds=5))
+        by_id, _ = get_messages_since(self.alice, seen.id, self.bob.id)
+        self.assertEqual(by_id, [])
+        by_time, complete = get_messages_since(self.alice, seen.id, self.bob.id, overlap=timedelta(seconds=5))
+        self.assertEqual([m.id for m in by_time], [seen.id, late.id])
+        self.assertTrue(complete)
+
+
+class ReadWatermarkTests(ChatSocketTestCase):
+
+    async def test_watermark_is_clamped_to_the_conversation(self):
+        bob = await self.connect(self.bob)
+        alice = await self.connect(self.alice)
+        await self.send_message(bob, 'alice', 'one')
+        (first,) = [event for event in await self.receive_events(alice) if event['type'] == 'chat_message']
+        await self.receive_events(bob)
+
+        # An id from some other conversation, far ahead of this one
+        await alice.send_json_to({'type': 'read', 'receiver': 'bob', 'last_read_id': first['id'] + 1000})
+        receipts = [event for event in await self.receive_events(bob) if event['type'] == 'read_receipt']
+        self.assertEqual([event['last_read_id'] for event in receipts], [first['id']])
+
+        await self.send_message(bob, 'alice', 'two')
+        (second,) = [event for event in await self.receive_events(alice) if event['type'] == 'chat_message']
+        self.assertEqual(await database_sync_to_async(get_unread_counts)(self.alice.id), {'bob': 1})
+        await alice.send_json_to({'type': 'read', 'receiver': 'bob', 'last_read_id': second['id']})
+        await self.receive_events(alice)
+        self.assertEqual(await database_sync_to_async(get_unread_counts)(self.alice.id), {})
+        await alice.disconnect()
+        await bob.disconnect()
+
+    def test_watermark_stored_past_the_newest_message_heals(self):
+        first = Message.objects.create(sender=self.bob, receiver=self.alice, content='one')
+        conversation = Conversation.objects.get()
+        side = Conversation.side(self.alice.id, self.bob.id)
+        Conversation.objects.filter(pk=conversation.pk).update(**{f'{side}_last_read_id': first.id + 1000})
+        second = Message.objects.create(sender=self.bob, receiver=self.alice, content='two')
+        self.assertEqual(mark_read(self.alice.id, self.bob.id, second.id), second.id)
+        self.assertEqual(Conversation.objects.get().unread_for(self.alice), 0)
+        self.assertIsNone(mark_read(self.alice.id, self.bob.id, second.id))
+
+
+class SlowClientTests(ChatSocketTestCase):
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_SIZE=5, CHAT_OUTBOUND_HIGH_WATER=3)
+    async def test_client_that_stops_reading_is_closed(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        sent = asyncio.Event()
+
+        async def never_drains(*args, **kwargs):
+            sent.set()
+            await asyncio.Event().wait()
+
+        # Whatever alice's socket sends next never completes
+        real_send = ChatConsumer.send
+        ChatConsumer.send = lambda consumer, *args, **kwargs: (
+            never_drains() if consumer.user == self.alice else real_send(consumer, *args, **kwargs)
+        )
+        self.addCleanup(setattr, ChatConsumer, 'send', real_send)
+        for i in range(8):
+            await self.send_message(bob, 'alice', f'message {i}')
+
+        with self.assertLogs('chatapp.consumers', 'WARNING'):
+            close = await alice.receive_output(timeout=2)
+        self.assertEqual(close, {'type': 'websocket.close', 'code': SLOW_CLIENT_CLOSE_CODE})
+        self.assertTrue(sent.is_set())
+        await bob.disconnect()
@@ -0,0 +1,105 @@
+# chatapp/unread.py
+"""
+Per-participant read state of a Conversation.
+
+Each side of a Conversation holds a read watermark (the last message id
+that participant has read) and the number of messages that arrived after
+it. The count goes up when a message is saved (see conversations.py);
+reading moves the watermark forward and recounts only what lies past it,
+in one UPDATE however many messages that covers. Each receiver's counts
+are mirrored in the cache as a {sender_username: count} dict, so reading
+them is a single cache hit instead of a GROUP BY over Message.
+"""
+import logging
+from django.core.cache import cache
+from django.db import models
+from django.db.models.functions import Coalesce
+from .groups import user_group_name
+from .metrics import group_send
+
+logger = logging.getLogger(__name__)
+
+UNREAD_CACHE_TIMEOUT = 60 * 60
+
+
+def _cache_key(receiver_id):
+    return f'unread:{receiver_id}'
+
+
+def invalidate_unread_counts(receiver_id):
+    """Drop the cached counts after a receiver's unread state changed"""
+    cache.delete(_cache_key(receiver_id))
+
+
+def mark_read(receiver_id, sender_id, last_read_id):
+    """
+    Move the read watermark up to message `last_read_id`, returns the new watermark or None if it didn't move.
+
+    The watermark never goes past the newest message sender has sent to
+    receiver, whatever id the client reports.
+    """
+    from .models import Conversation, Message
+    side = Conversation.side(receiver_id, sender_id)
+    pair = Conversation.pair(receiver_id, sender_id)
+    newest_id = (Message.objects.filter(sender_id=sender_id, receiver_id=receiver_id)
+                 .order_by('-id').values_list('id', flat=True).first())
+    last_read_id = min(last_read_id, newest_id or 0)
+    if last_read_id <= 0:
+        return None
+    # Whatever arrived after the watermark stays unread: a short primary key range, usually empty
+    newer = (Message.objects.filter(sender_id=sender_id, receiver_id=receiver_id, pk__gt=last_read_id)
+             .order_by().values('sender_id').annotate(unread=models.Count('id')).values('unread'))
+    # A watermark past the newest message (stored before it was clamped) is pulled back too
+    advanced = bool(Conversation.objects.filter(
+        models.Q(**{f'{side}_last_read_id__lt': last_read_id}) | models.Q(**{f'{side}_last_read_id__gt': newest_id}),
+        **pair
+    ).update(**{
+        f'{side}_last_read_id': last_read_id,
+        f'{side}_unread': Coalesce(models.Subquery(newer), 0),
+    }))
+    if not advanced:
+        # Either already read that far or the two never talked
+        _, advanced = Conversation.objects.get_or_create(**pair, defaults={f'{side}_last_read_id': last_read_id})
+    if not advanced:
+        return None
+    invalidate_unread_counts(receiver_id)
+    return last_read_id
+
+
+def get_read_watermark(receiver_id, sender_id):
+    """Id of the last message from sender that receiver has read (0 if none)"""
+    from .models import Conversation
+    side = Conversation.side(receiver_id, sender_id)
+    return Conversation.objects.filter(
+        **Conversation.pair(receiver_id, sender_id)
+    ).values_list(f'{side}_last_read_id', flat=True).first() or 0
+
+
+def get_unread_counts(receiver_id):
+    """{sender_username: count} for everything the user has not read yet"""
+    from .models import Conversation
+    key = _cache_key(receiver_id)
+    counts = cache.get(key)
+    if counts is None:
+        rows = Conversation.objects.filter(
+            models.Q(user_low_id=receiver_id, low_unread__gt=0) |
+            models.Q(user_high_id=receiver_id, high_unread__gt=0)
+        ).values_list('user_low_id', 'user_low__username', 'low_unread', 'user_high__username', 'high_unread')
+        counts = {}
+        for low_id, low_username, low_unread, high_username, high_unread in rows:
+            if low_id == receiver_id:
+                counts[high_username] = low_unread
+            else:
+                counts[low_username] = high_unread
+        cache.set(key, counts, UNREAD_CACHE_TIMEOUT)
+    return counts
+
+
+async def send_read_receipt(channel_layer, reader, sender_id, last_read_id):
+    """Tell every socket of the sender how far `reader` has read their messages"""
+    await group_send(channel_layer, user_group_name(sender_id), {
+        'type': 'read_receipt',
+        'reader': reader,
+        'last_read_id': last_read_id
+    })
+
@@ -7,6 +7,9 @@ urlpatterns = [
     path('chat/<str:username>/', views.chat, name='chat'),
     path('save-message/', views.save_message, name='save_message'),
     path('get-unread-counts/', views.get_unread_counts, name='get_unread_counts'),
+    path('search/', views.search, name='search'),
+    path('export/', views.export, name='export'),
     path('add-friend/', views.add_friend, name='send_friend_request'),
     path('friend-request/<str:action>/', views.accept_or_decline_request, name='send_friend_request'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -4,13 +4,24 @@ from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db import models
-from .models import Message, FriendRequest
-from django.http import JsonResponse
+from django.db import transaction
+from .models import Conversation, Message, FriendRequest
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, HttpResponseBadRequest, HttpResponseForbidden, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views.decorators.csrf import csrf_exempt
-from django.core.paginator import Paginator
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 import json
 from .forms import CustomUserForm
+from .metrics import registry, timed_view
+from .conversations import find_conversation_id
+from .directory import user_directory
+from .pagination import get_history_page
+from .search import search_messages
+from .export import EXPORT_FORMATS, aiter_export
+from . import friends, history_cache, unread
 
 def logout_view(request):
     logout(request)
@@ -28,53 +39,40 @@ def signup(request):
     return render(request, 'chatapp/signup.html', {'form': form})
 
 @login_required
+@timed_view
 def users(request):
+    # friends and open requests come from the cached friend graph, no per-user Exists subqueries
+    graph = friends.get_friend_graph(request.user.id)
     users = User.objects.filter(is_superuser=False).exclude(id=request.user.id)
 
-    users_annotated = users.annotate(
-        # if already friends
-        is_friend = models.Exists(
-            FriendRequest.objects.filter(
-                models.Q(sender=request.user, receiver=models.OuterRef('pk')) |
-                models.Q(receiver=request.user, sender=models.OuterRef('pk')),
-                status=FriendRequest.Status.ACCEPTED
-            )
-        ),
-        # if I've a pending request from them
-        sent_pending = models.Exists(
-            FriendRequest.objects.filter(
-                sender=models.OuterRef('pk'),
-                receiver=request.user,
-                status=FriendRequest.Status.PENDING
-            )
-        ),
-        # if I've sent them a request & is pending
-        i_sent_request = models.Exists(
-            FriendRequest.objects.filter(
-                sender=request.user,
-                receiver=models.OuterRef('pk'),
-            )
-        )
-    ).select_related()
-
-    chat_users = users_annotated.filter(is_friend=True)
-    addable_users = users_annotated.filter(
-        is_friend=False,
-        sent_pending=False,
-        i_sent_request=False
-    )
+    addable_users = users.exclude(id__in=graph['friends'] | graph['incoming'] | graph['outgoing'])
     pending_requests = FriendRequest.objects.filter(
         receiver=request.user, 
         status=FriendRequest.Status.PENDING
     ).select_related('sender')
 
-     
+    # inbox: conversations newest first with their last message, then friends we never talked to
+    conversations = list(
+        Conversation.involving(request.user)
+        .filter(last_activity__isnull=False)
+        .select_related('user_low', 'user_high', 'last_message')
+        .order_by('-last_activity')
+    )
+    Message.decrypt_many([c.last_message for c in conversations if c.last_message is not None])
+    inbox = [
+        {'user': c.other_user(request.user), 'last_message': c.last_message, 'unread': c.unread_for(request.user)}
+        for c in conversations
+    ]
+    silent_friends = graph['friends'] - {entry['user'].id for entry in inbox}
+    chat_users = User.objects.filter(id__in=silent_friends).order_by('username') if silent_friends else []
+    inbox += [{'user': user, 'last_message': None, 'unread': 0} for user in chat_users]
+
     return render(
         request, 
         'chatapp/users.html', 
         {
             'users': users,
-            'chat_users': chat_users,
+            'inbox': inbox,
             'pending_requests': pending_requests,
             'addable_users': addable_users
         }
@@ -94,7 +92,8 @@ def save_message(request):
                 receiver=receiver,
             )
             message.content = data['message']  # Automatically encrypts
-            message.save()
+            with transaction.atomic():  # together with the conversation update
+                message.save()
 
             return JsonResponse({
                 'status': 'success',
@@ -107,24 +106,28 @@ def save_message(request):
 
 
 @login_required
+@timed_view
 def chat(request, username):
+    before = request.GET.get('before')
+    if before and request.headers.get('HX-Request'):
+        other_user_id = user_directory.lookup(username)
+        if other_user_id is not None:
+            return older_messages(request, other_user_id, before)
+
     other_user = User.objects.get(username=username)
 
-    # mark message from other_user to current user as read
-    Message.objects.filter(
-        sender = other_user,
-        receiver = request.user,
-        is_read = False
-    ).update(is_read=True)
-
-    messages = Message.objects.filter(
-        (models.Q(sender=request.user, receiver=other_user) |
-         models.Q(sender=other_user, receiver=request.user))
-    ).order_by('timestamp')
-    
-    paginator = Paginator(messages, 10) #number kept low for testing, set to optimal number of messages
-    page_number = request.GET.get('page', paginator.num_pages)
-    messages_page = paginator.get_page(page_number)
+    # newest page by default, older pages via the opaque 'before' cursor
+    try:
+        messages_page = get_history_page(request.user, other_user, before=request.GET.get('before'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid history cursor')
+
+    # opening the chat reads everything up to the newest message from other_user (one UPDATE)
+    newest_id = max((m.id for m in messages_page if m.sender_id == other_user.id), default=None)
+    if newest_id and not request.GET.get('before') and unread.mark_read(request.user.id, other_user.id, newest_id):
+        async_to_sync(unread.send_read_receipt)(
+            get_channel_layer(), request.user.username, other_user.id, newest_id
+        )
 
     if request.headers.get('HX-Request'):
         return render(request, 'chatapp/partials/message_list.html', {
@@ -134,21 +137,77 @@ def chat(request, username):
 
     return render(request, 'chatapp/chat.html', {
         'other_user': other_user,
-        'messages': messages_page  # content is auto-decrypted
+        'messages': messages_page,  # content is auto-decrypted
+        'peer_last_read_id': unread.get_read_watermark(other_user.id, request.user.id)
     })
 
+def older_messages(request, other_user_id, before):
+    """htmx scroll-back page, immutable so it is served from the fragment cache with an ETag"""
+    conversation_id = find_conversation_id(request.user.id, other_user_id)
+    if conversation_id is None:
+        return HttpResponse('')  # they never talked, so there is nothing older
+    key = history_cache.page_key(conversation_id, request.user.id, before)
+    etag = history_cache.page_etag(key)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        fragment = history_cache.get_page(key)
+        if fragment is None:
+            other_user = User.objects.get(pk=other_user_id)
+            try:
+                messages_page = get_history_page(request.user, other_user, before=before)
+            except ValueError:
+                return HttpResponseBadRequest('Invalid history cursor')
+            fragment = render_to_string('chatapp/partials/message_list.html', {
+                'messages': messages_page,
+                'other_user': other_user
+            }, request=request)
+            history_cache.set_page(key, fragment)
+        response = HttpResponse(fragment)
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)  # always revalidate, the ETag makes it a 304
+    return response
+
 @login_required
+@timed_view
 def get_unread_counts(request):
     """return a json unread message counts by sender"""
-    unread_counts = Message.objects.filter(
-        receiver=request.user,
-        is_read=False
-    ).values('sender__username').annotate(count=models.Count('id'))
+    return JsonResponse(unread.get_unread_counts(request.user.id))
+
+@login_required
+@timed_view
+def search(request):
+    """ids of the user's messages containing every word of ?q=, newest first (?with=username, ?before=id)"""
+    other_user_id = None
+    if request.GET.get('with'):
+        other_user_id = User.objects.filter(username=request.GET['with']).values_list('id', flat=True).first()
+        if other_user_id is None:
+            return JsonResponse({'status': 'error', 'error': 'Unknown user'}, status=404)
+    try:
+        before = int(request.GET['before']) if request.GET.get('before') else None
+    except ValueError:
+        return HttpResponseBadRequest('Invalid search cursor')
 
-    # Update this line to use sender__username instead of sender_username
-    result = {item['sender__username']: item['count'] for item in unread_counts}
-    print(result)
-    return JsonResponse(result)
+    message_ids, next_before = search_messages(request.user, request.GET.get('q', ''), other_user_id, before)
+    return JsonResponse({'message_ids': message_ids, 'next_before': next_before})
+
+@login_required
+def export(request):
+    """streams all of the user's messages (or ?with=username) as ?format=jsonl|csv"""
+    export_format = request.GET.get('format', 'jsonl')
+    if export_format not in EXPORT_FORMATS:
+        return HttpResponseBadRequest('Unknown export format')
+    other_user = None
+    if request.GET.get('with'):
+        other_user = User.objects.filter(username=request.GET['with']).first()
+        if other_user is None:
+            return JsonResponse({'status': 'error', 'error': 'Unknown user'}, status=404)
+
+    name = '-'.join(['zeenchat', request.user.username] + ([other_user.username] if other_user else []))
+    response = StreamingHttpResponse(
+        aiter_export(request.user, other_user, export_format), content_type=EXPORT_FORMATS[export_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="{name}.{export_format}"'
+    return response
 
 @login_required
 def add_friend(request):
@@ -162,6 +221,7 @@ def add_friend(request):
                 sender=request.user,
                 receiver=user   
             )
+            friends.invalidate_friend_graph(request.user.id, user.id)
 
             return JsonResponse({'status': 'success', 'message': 'Friend request sent'})
         
@@ -184,16 +244,25 @@ def accept_or_decline_request(request, action):
             )
 
             if action == 'accept':
-                request_obj.status = FriendRequest.Status.ACCEPTED
-                request_obj.save()
-                # request_obj.refresh_from_db()
+                friends.add_friendship(request_obj)
                 return JsonResponse({'status': 'sucess', 'message': 'Friend request accepted'})
 
             # upon decline, we'd delete the request obj. so user will be again available to send request.
             if action == 'decline':
                 request_obj.delete()
+                friends.invalidate_friend_graph(sender.id, request.user.id)
                 return JsonResponse({'status': 'sucess', 'message': 'Friend request declined'})
         
         except Exception as e:
             return JsonResponse({'status': 'error', 'error': str(e)}, status=400)
     return JsonResponse({'status': 'error', 'error': 'Invalid request method'}, status=400)
+
+def metrics(request):
+    """Prometheus scrape endpoint: "Authorization: Bearer <METRICS_TOKEN>", or a staff session if no token is set"""
+    token = settings.METRICS_TOKEN
+    if not token:
+        if not request.user.is_staff:
+            raise Http404()  # Closed unless configured
+    elif request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -25,6 +26,24 @@ ENVIRONMENT = os.getenv("ENVIRONMENT", "local").lower()
 SECRET_KEY = os.getenv("SECRET_KEY", "qwerty")
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 
+# Message encryption keyring as "key_id:secret,key_id:secret". The first key
+# encrypts new messages, all of them can decrypt (rotate by prepending a key).
+# Defaults to a single key derived from SECRET_KEY.
+MESSAGE_ENCRYPTION_KEYS = [
+    tuple(entry.split(":", 1))
+    for entry in os.getenv("MESSAGE_ENCRYPTION_KEYS", "").split(",") if entry
+] or [("default", SECRET_KEY)]
+if any(len(key) != 2 or not all(key) for key in MESSAGE_ENCRYPTION_KEYS):
+    raise ImproperlyConfigured("MESSAGE_ENCRYPTION_KEYS entries must look like key_id:secret")
+
+# Secret behind the message search index (HMAC tokens of words). Changing it
+# means rebuilding the index with `manage.py backfill_search_index --rebuild`.
+MESSAGE_SEARCH_KEY = os.getenv("MESSAGE_SEARCH_KEY", SECRET_KEY)
+
+# Where `manage.py archive_messages` moves old messages (gzip segments, still
+# encrypted). Must be shared by every web/worker process that serves history.
+MESSAGE_ARCHIVE_DIR = Path(os.getenv("MESSAGE_ARCHIVE_DIR", BASE_DIR / "archive"))
+
 ALLOWED_HOSTS = ["*"]
 
 
@@ -43,14 +62,77 @@ INSTALLED_APPS = [
     'widget_tweaks',
 ]
 
-CHANNEL_LAYERS = {
-    "default": {
+REDIS_URL = f"redis://:{os.getenv('REDIS_PASSWORD', '')}@{os.getenv('REDIS_HOST', '127.0.0.1')}:{os.getenv('REDIS_PORT', 6379)}"
+
+# Channel layer, picked with CHANNEL_LAYER_BACKEND:
+# "redis"  - channels_redis core layer. Channels and groups are sharded over
+#            CHANNEL_REDIS_HOSTS (comma separated URLs, default REDIS_URL).
+#            Each channel buffers up to CHANNEL_LAYER_CAPACITY messages for
+#            CHANNEL_LAYER_EXPIRY seconds. Group memberships last
+#            CHANNEL_LAYER_GROUP_EXPIRY seconds, which must outlive the
+#            longest socket.
+# "pubsub" - channels_redis pub/sub layer over the same hosts. There is no
+#            buffering or capacity: a message reaches whoever is listening.
+# "memory" - a single process only, for development.
+# Compare them with `manage.py benchmark_fanout`.
+CHANNEL_LAYER_BACKEND = os.getenv("CHANNEL_LAYER_BACKEND", "redis").lower()
+CHANNEL_REDIS_HOSTS = [host for host in os.getenv("CHANNEL_REDIS_HOSTS", "").split(",") if host] or [REDIS_URL]
+CHANNEL_LAYER_LIMITS = {
+    "capacity": int(os.getenv("CHANNEL_LAYER_CAPACITY", 100)),
+    "expiry": int(os.getenv("CHANNEL_LAYER_EXPIRY", 60)),
+    "group_expiry": int(os.getenv("CHANNEL_LAYER_GROUP_EXPIRY", 86400)),
+}
+CHANNEL_LAYER_BACKENDS = {
+    "redis": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [f"redis://:{os.getenv('REDIS_PASSWORD', '')}@{os.getenv('REDIS_HOST', '127.0.0.1')}:{os.getenv('REDIS_PORT', 6379)}"],
-        },
-    }
+        "CONFIG": {"hosts": CHANNEL_REDIS_HOSTS, **CHANNEL_LAYER_LIMITS},
+    },
+    "pubsub": {
+        "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+        "CONFIG": {"hosts": CHANNEL_REDIS_HOSTS},
+    },
+    "memory": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": CHANNEL_LAYER_LIMITS,
+    },
 }
+if CHANNEL_LAYER_BACKEND not in CHANNEL_LAYER_BACKENDS:
+    raise ImproperlyConfigured(f"CHANNEL_LAYER_BACKEND must be one of {', '.join(CHANNEL_LAYER_BACKENDS)}")
+CHANNEL_LAYERS = {"default": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER_BACKEND]}
+
+# How ChatConsumer stores messages: "sync" (INSERT before broadcast) or
+# "batched" (broadcast first, bulk_create in the background, PostgreSQL only)
+CHAT_MESSAGE_DURABILITY = os.getenv("CHAT_MESSAGE_DURABILITY", "sync").lower()
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BEHIND_BATCH_SIZE", 100))
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("CHAT_WRITE_BEHIND_FLUSH_INTERVAL", 0.2))  # seconds
+# While flushes fail: retry after doubling delays up to this many seconds, and keep
+# at most this many messages buffered (the oldest are dropped and counted past it)
+CHAT_WRITE_BEHIND_MAX_BACKOFF = float(os.getenv("CHAT_WRITE_BEHIND_MAX_BACKOFF", 30))
+CHAT_WRITE_BEHIND_MAX_BUFFER = int(os.getenv("CHAT_WRITE_BEHIND_MAX_BUFFER", 10000))
+
+# With "batched", each worker takes ids from its own reserved block, so a lower id
+# can be stored after a higher one. Reconnecting sockets then replay by timestamp,
+# starting this many seconds before their last message. A message whose flush is
+# delayed longer than that (database outage) only shows up after a page reload.
+CHAT_RESUME_OVERLAP = float(os.getenv("CHAT_RESUME_OVERLAP", 5))
+
+# Seconds a typing indicator stays on without a fresh "typing" frame
+CHAT_TYPING_TIMEOUT = float(os.getenv("CHAT_TYPING_TIMEOUT", 5))
+
+# Seconds outbound events are collected into one frame for msgpack clients
+CHAT_BATCH_WINDOW = float(os.getenv("CHAT_BATCH_WINDOW", 0.01))
+
+# Outbound events queued per socket before a slow client is disconnected (see chatapp/outbound.py)
+CHAT_OUTBOUND_QUEUE_SIZE = int(os.getenv("CHAT_OUTBOUND_QUEUE_SIZE", 500))
+
+# Queue length from which typing and presence events are dropped instead of queued
+CHAT_OUTBOUND_HIGH_WATER = int(os.getenv("CHAT_OUTBOUND_HIGH_WATER", 200))
+
+# Seconds a socket may stay above the high-water mark before it is disconnected
+CHAT_SLOW_CLIENT_TIMEOUT = float(os.getenv("CHAT_SLOW_CLIENT_TIMEOUT", 10))
+
+# Bearer token required to scrape /metrics (without one only staff sessions can read it)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -100,6 +182,37 @@ DATABASES = {
     }
 }
 
+# Connection reuse: "none" opens a connection per request / consumer DB call,
+# "persistent" keeps each thread's connection for PG_CONN_MAX_AGE seconds,
+# "pool" uses psycopg 3's connection pool (pip install "psycopg[binary,pool]")
+PG_CONN_MODE = os.getenv("PG_CONN_MODE", "none").lower()
+if PG_CONN_MODE == "persistent":
+    DATABASES["default"]["CONN_MAX_AGE"] = int(os.getenv("PG_CONN_MAX_AGE", 60))
+    DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+elif PG_CONN_MODE == "pool":
+    try:
+        import psycopg  # noqa: F401 (Django only pools with psycopg 3, not psycopg2)
+        from psycopg_pool import ConnectionPool
+    except ImportError:
+        raise ImproperlyConfigured(
+            'PG_CONN_MODE=pool needs psycopg 3 and its pool: pip install "psycopg[binary,pool]"'
+        )
+
+    DATABASES["default"]["OPTIONS"]["pool"] = {
+        "min_size": int(os.getenv("PG_POOL_MIN_SIZE", 2)),
+        "max_size": int(os.getenv("PG_POOL_MAX_SIZE", 20)),
+        "timeout": float(os.getenv("PG_POOL_TIMEOUT", 10)),
+        "check": ConnectionPool.check_connection,
+    }
+elif PG_CONN_MODE != "none":
+    raise ImproperlyConfigured(f"Unknown PG_CONN_MODE {PG_CONN_MODE!r}")
+
+# Threads running consumer DB calls, 0 keeps asgiref's single thread-sensitive thread.
+# Size it to the connection pool (each thread holds at most one connection).
+DB_THREAD_POOL_SIZE = int(os.getenv(
+    "DB_THREAD_POOL_SIZE", DATABASES["default"]["OPTIONS"].get("pool", {}).get("max_size", 0)
+))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -150,6 +263,23 @@ LOGOUT_REDIRECT_URL = 'login'
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
-        'LOCATION': CHANNEL_LAYERS['default']['CONFIG']['hosts'][0],
+        'LOCATION': REDIS_URL,
     }
 }
+
+# Presence heartbeats: sockets ping every PRESENCE_PING_INTERVAL seconds and
+# count as online until PRESENCE_TTL seconds after their last ping. One worker
+# writes is_online/last_seen every PRESENCE_FLUSH_INTERVAL seconds.
+# PRESENCE_BACKEND is "redis" (shared by all workers) or "local" (one process).
+PRESENCE_BACKEND = os.getenv("PRESENCE_BACKEND", "redis").lower()
+PRESENCE_REDIS_URL = os.getenv("PRESENCE_REDIS_URL", REDIS_URL)
+PRESENCE_PING_INTERVAL = int(os.getenv("PRESENCE_PING_INTERVAL", 20))
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", 60))
+PRESENCE_FLUSH_INTERVAL = int(os.getenv("PRESENCE_FLUSH_INTERVAL", 3))
+PRESENCE_LAST_SEEN_INTERVAL = int(os.getenv("PRESENCE_LAST_SEEN_INTERVAL", 60))
+
+# Sessions are read from the cache (written through to the database), so
+# cached pages such as older chat history don't need a session query. This
+# applies site-wide and relies on the Redis cache above; set
+# SESSION_ENGINE=django.contrib.sessions.backends.db for database-only sessions.
+SESSION_ENGINE = os.getenv("SESSION_ENGINE", "django.contrib.sessions.backends.cached_db")